@@ -46,7 +46,8 @@ class Card(object):
             self.nav2Override = Entity(card_input_config.get("navItem2"))
         self.sleepTimeout  = card_input_config.get("sleepTimeout")
         self.last_update = 0
-        self.cooldown = card_input_config.get("cooldown", 0)
+        # None uses renderInterval of the panel
+        self.cooldown = card_input_config.get("cooldown")
         # for single entity card like climate or media
         self.entity = None
         if card_input_config.get("entity") is not None:
@@ -56,6 +57,7 @@ class Card(object):
         for e in card_input_config.get("entities", []):
             self.entities.append(Entity(e))
         self.id = f"{self.cardType}_{self.key}".replace(".","_").replace("~","_").replace(" ","_")
+        self._entity_uuids = None
         
     def get_entity_names(self, uuid=False):
         entityIds = {}
@@ -88,6 +90,16 @@ class Card(object):
                 out.extend(l)
             return out
 
+    def get_entity_uuids(self):
+        # entity ids on this card mapped to the uuids of their items, built once
+        # as the config of a card doesn't change
+        if self._entity_uuids is None:
+            self._entity_uuids = {}
+            for uuid, names in self.get_entity_names(uuid=True).items():
+                for name in names:
+                    self._entity_uuids.setdefault(name, []).append(uuid)
+        return self._entity_uuids
+
     def get_entity_list(self):
         entitys = []
         if self.entity is not None:
@@ -124,6 +136,7 @@ class LuiBackendConfig(object):
             'updateMode': "auto-notify",
             'model': "eu",
             'sleepTimeout': 20,
+            'renderInterval': 0.1,
             'sleepBrightness': 20,
             'screenBrightness': 100,
             'defaultBackgroundColor': "ha-dark",
@@ -235,6 +248,7 @@ class LuiBackendConfig(object):
         entities = []
         for card in self._config_cards:
             entities.extend(card.get_entity_list())
+        entities.extend(self._config_screensaver.get_entity_list())
         return entities
 
     def search_card(self, id):
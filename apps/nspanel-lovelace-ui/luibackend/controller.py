@@ -1,4 +1,5 @@
 import datetime
+import time
 
 import apis
 from helper import scale, pos_to_color, rgb_dec565
@@ -14,6 +15,11 @@ class LuiController(object):
         self._current_card = self._config._config_screensaver
 
         self._previous_cards = []
+        self._pending_card_update = None
+        # (detail_type, entity_id) of the popup shown on the panel and the
+        # HA entity of it, detail pages are only sent for this entity
+        self._open_detail = None
+        self._open_detail_entity = None
         # first card (default, after startup)
         self._previous_cards.append(self._config.get_default_card())
         self._pages_gen = LuiPagesGen(config, send_mqtt_msg)
@@ -30,6 +36,7 @@ class LuiController(object):
 
     def startup(self):
         apis.ha_api.log(f"Startup Event")
+        self.close_detail()
         # send time and date on startup
         self._pages_gen.update_time("")
         self._pages_gen.update_date("")
@@ -160,50 +167,58 @@ class LuiController(object):
     def state_change_callback(self, entity, attribute, old, new, kwargs):
         #apis.ha_api.log(f"Got callback for: {entity}")
         #apis.ha_api.log(f"Current page has the following items: {self._current_card.get_entity_names(uuid=True)}")
-        entities_on_card = self._current_card.get_entity_names(uuid=True)
-
-        res_uuid = "uuid.notfound"
-        if entity in sum(entities_on_card.values(), []):
-            for uuid, names in entities_on_card.items():
-                #apis.ha_api.log(f"test124 items: {entities_on_card.items()} names: {names}")
-                #apis.ha_api.log(f"State change callback matched for entity on current page: {names}")
-                if entity in names:
-                    res_uuid = uuid
-
+        if entity in self._current_card.get_entity_uuids():
             #apis.ha_api.log(f"Callback Entity is on current page: {entity}")
+            self.update_current_card()
+            # send detail page update if the popup of the entity is open
+            if self._open_detail is not None and entity == self._open_detail_entity:
+                self.send_detail_page(*self._open_detail)
+
+
+    def update_current_card(self):
+        # render state changes at most once per cooldown of the card (or
+        # renderInterval), changes within it are sent together when it is over
+        card = self._current_card
+        cooldown = card.cooldown if card.cooldown is not None else self._config.get("renderInterval")
+        wait = cooldown - (time.time() - card.last_update)
+        if wait <= 0:
+            self._pages_gen.render_card(card, send_page_type=False)
+        elif self._pending_card_update is None:
+            self._pending_card_update = apis.ha_api.run_in(self.pending_card_update_callback, wait, card_uuid=card.uuid)
+
+    def pending_card_update_callback(self, kwargs):
+        self._pending_card_update = None
+        if self._current_card.uuid == kwargs["card_uuid"]:
             self._pages_gen.render_card(self._current_card, send_page_type=False)
-            # send detail page update, just in case
-            if self._current_card.cardType in ["cardGrid", "cardGrid2", "cardEntities", "cardMedia"]:
-                if entity.startswith("light"):
-                    self._pages_gen.generate_light_detail_page(res_uuid)
-                if entity.startswith("cover"):
-                    self._pages_gen.generate_shutter_detail_page(entity)
-                if entity.startswith("fan"):
-                    self._pages_gen.generate_fan_detail_page(entity)
-                if entity.startswith("input_select") or entity.startswith("select"):
-                    self._pages_gen.generate_input_select_detail_page(entity)
-                if entity.startswith("media_player"):
-                    self._pages_gen.generate_input_select_detail_page(entity)
-                if entity.startswith("timer"):
-                    self._pages_gen.generate_timer_detail_page(entity)
-            if self._current_card.cardType == "cardThermo":
-                if entity.startswith("climate"):
-                    self._pages_gen.generate_thermo_detail_page(entity)
-
 
     def detail_open(self, detail_type, entity_id):
+        self._pages_gen.stop_timer_countdown()
+        self._open_detail = (detail_type, entity_id)
+        self._open_detail_entity = entity_id
+        if entity_id.startswith('uuid'):
+            entity_config = self._config._config_entites_table.get(entity_id)
+            if entity_config is not None:
+                self._open_detail_entity = entity_config.entityId
+        self.send_detail_page(detail_type, entity_id, True)
+
+    def close_detail(self):
+        self._pages_gen.stop_timer_countdown()
+        self._open_detail = None
+        self._open_detail_entity = None
+
+    def send_detail_page(self, detail_type, entity_id, is_open_detail=False):
         if detail_type == "popupShutter":
-            self._pages_gen.generate_shutter_detail_page(entity_id, True)
+            self._pages_gen.generate_shutter_detail_page(entity_id, is_open_detail)
         if detail_type == "popupLight":
-            self._pages_gen.generate_light_detail_page(entity_id, True)
+            self._pages_gen.generate_light_detail_page(entity_id, is_open_detail)
         if detail_type == "popupFan":
-            self._pages_gen.generate_fan_detail_page(entity_id, True)
+            self._pages_gen.generate_fan_detail_page(entity_id, is_open_detail)
         if detail_type == "popupThermo":
-            self._pages_gen.generate_thermo_detail_page(entity_id, True)
+            self._pages_gen.generate_thermo_detail_page(entity_id, is_open_detail)
         if detail_type == "popupInSel":
-            self._pages_gen.generate_input_select_detail_page(entity_id, True)
+            self._pages_gen.generate_input_select_detail_page(entity_id, is_open_detail)
         if detail_type == "popupTimer":
-            self._pages_gen.generate_timer_detail_page(entity_id, True)
+            self._pages_gen.generate_timer_detail_page(entity_id, is_open_detail)
 
     def button_press(self, entity_id, button_type, value):
         apis.ha_api.log(f"Button Press Event; entity_id: {entity_id}; button_type: {button_type}; value: {value} ")
@@ -211,6 +226,10 @@ class LuiController(object):
             entity_config = self._config._config_entites_table.get(entity_id)
             if entity_config is not None:
                 entity_id = entity_config.entityId
+        # popups are closed with bExit, the panel closes them when it goes to sleep as well
+        if button_type in ["bExit", "sleepReached"]:
+            self.close_detail()
+
         # internal buttons
         if entity_id == "screensaver" and button_type == "bExit":
             # get default card if there is one
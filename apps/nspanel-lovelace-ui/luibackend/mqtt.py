@@ -1,11 +1,17 @@
 import json
 import apis
 
+# commands that are only sent if the payload changed since the last one
+DEDUPLICATED_COMMANDS = ["entityUpd", "entityUpdateDetail", "entityUpdateDetail2", "statusUpdate", "weatherUpdate", "time", "date", "dimmode"]
+# commands showing content of the current page, the panel forgets them on page changes
+PAGE_COMMANDS = ["entityUpd", "entityUpdateDetail", "entityUpdateDetail2", "statusUpdate", "weatherUpdate"]
+
 class LuiMqttListener(object):
 
-    def __init__(self, use_api, topic, api_panel_name, api_device_id, controller, updater):
+    def __init__(self, use_api, topic, api_panel_name, api_device_id, controller, updater, sender):
         self._controller = controller
         self._updater = updater
+        self._sender = sender
         self._api_device_id = api_device_id
 
         # Setup, mqtt subscription and callback
@@ -47,6 +53,8 @@ class LuiMqttListener(object):
         # run action based on received command
         if msg[0] == "event":
             if msg[1] == "startup":
+                # panel restarted and lost everything we sent before
+                self._sender.invalidate()
                 self._updater.request_berry_driver_version()
                 display_firmware_version = int(msg[2])
                 model                    = msg[3]
@@ -83,12 +91,22 @@ class LuiMqttSender(object):
         self._topic_send = topic_send
         self._api_panel_name = api_panel_name
         self._prev_msg = ""
+        self._last_sent = {}
         self._quiet = quiet
 
     def send_mqtt_msg(self, msg, topic=None, force=False):
-        if not force and self._prev_msg == msg:
+        command = msg.split("~", 1)[0]
+        if command in DEDUPLICATED_COMMANDS:
+            if not force and self._last_sent.get(command) == msg:
+                apis.ha_api.log(f"Dropping unchanged message: {msg}")
+                return
+            self._last_sent[command] = msg
+        elif not force and self._prev_msg == msg:
             apis.ha_api.log(f"Dropping identical consecutive message: {msg}")
             return
+        if command == "pageType":
+            for c in PAGE_COMMANDS:
+                self._last_sent.pop(c, None)
         self._prev_msg = msg
 
         if self._quiet is False:
@@ -101,6 +119,10 @@ class LuiMqttSender(object):
                 topic = self._topic_send
             apis.mqtt_api.mqtt_publish(topic, msg)
 
+    def invalidate(self):
+        self._last_sent = {}
+        self._prev_msg = ""
+
     def request_berry_driver_version(self):
         if self._use_api:
             apis.ha_api.call_service(service="esphome/" + self._api_panel_name + "_nspanelui_api_call", command=1, data="x")
@@ -19,12 +19,34 @@ babel_spec = importlib.util.find_spec("babel")
 if babel_spec is not None:
     import babel.dates
 
+# weather forecasts shared by all panels, (entity_id, forecast type) -> (last_updated, fetch time, forecast)
+forecast_cache = {}
+FORECAST_CACHE_TTL = 15*60
+
+def get_forecast(entityId, forecast_type):
+    # only ask HA again if the weather entity changed or the forecast is too old
+    last_updated = apis.ha_api.get_state(entityId, attribute="last_updated")
+    cached = forecast_cache.get((entityId, forecast_type))
+    if cached and cached[0] == last_updated and time.time() - cached[1] < FORECAST_CACHE_TTL:
+        return cached[2]
+    results = apis.ha_api.call_service(
+        "weather/get_forecasts", target={"entity_id": entityId}, service_data={"type": forecast_type}
+    )
+    forecast = results.get("result", {}).get("response", {}).get(entityId, {}).get('forecast')
+    if forecast is not None:
+        forecast_cache[(entityId, forecast_type)] = (last_updated, time.time(), forecast)
+    return forecast
+
 class LuiPagesGen(object):
 
     def __init__(self, config, send_mqtt_msg):
         self._config = config
         self._locale  = config.get("locale")
         self._send_mqtt_msg = send_mqtt_msg
+        # rendered prev/next buttons by card uuid, they only depend on the config
+        self._nav_cache = {}
+        # (entity_id, handle) of the timer popup that is counting down
+        self._timer_countdown = None
 
     def get_entity_color(self, entity, ha_type=None, stateOverwrite=None, overwrite=None):
         if overwrite is not None:
@@ -403,10 +425,7 @@ class LuiPagesGen(object):
                     elif bits & 0b100: #FORECAST_TWICE_DAILY
                         rt = "twice_daily"
 
-                results = apis.ha_api.call_service(
-                    "weather/get_forecasts", target={"entity_id": entityId}, service_data={"type": rt}
-                )
-                forecast = results.get("result", {}).get("response", {}).get(entityId, {}).get('forecast') or entity.attributes.get('forecast', [])
+                forecast = get_forecast(entityId, rt) or entity.attributes.get('forecast', [])
                 if len(forecast) >= item.stype:
                     day_forecast = forecast[item.stype]
                     fdate = dp.parse(day_forecast['datetime'])
@@ -771,14 +790,9 @@ class LuiPagesGen(object):
             command += f"~{speed}"
         self._send_mqtt_msg(command)
 
-    def render_card(self, card, send_page_type=True):
-
-        # page type is false, so this request is from a callback
-        if not send_page_type and card.cooldown != 0:
-            if (time.time()-card.last_update) < card.cooldown:
-                return
-        card.last_update = time.time()
-
+    def generate_default_navigation(self, card):
+        if card.uuid in self._nav_cache:
+            return self._nav_cache[card.uuid]
 
         leftBtn = "delete~~~~~"
         if card.uuid_prev is not None:
@@ -804,6 +818,19 @@ class LuiPagesGen(object):
             leftBtn = f"x~navUp~{get_icon_id('mdi:arrow-up-bold')}~65535~~"
             rightBtn = "delete~~~~~"
 
+        self._nav_cache[card.uuid] = (leftBtn, rightBtn)
+        return leftBtn, rightBtn
+
+    def render_card(self, card, send_page_type=True):
+
+        card.last_update = time.time()
+
+        # leaving a page closes its popup as well
+        if send_page_type:
+            self.stop_timer_countdown()
+
+        leftBtn, rightBtn = self.generate_default_navigation(card)
+
         if card.nav1Override is not None:
             leftBtn = self.generate_entities_item(card.nav1Override)[1:]
 
@@ -1054,9 +1081,27 @@ class LuiPagesGen(object):
         options = "?".join(options)
         self._send_mqtt_msg(f"entityUpdateDetail2~{entity_id}~~{icon_color}~{ha_type}~{state}~{options}~", force=is_open_detail)
 
+    def start_timer_countdown(self, entity_id):
+        if self._timer_countdown is not None:
+            if self._timer_countdown[0] == entity_id:
+                return
+            self.stop_timer_countdown()
+        handle = apis.ha_api.run_every(self.timer_countdown_callback, "now+1", 1, entity_id=entity_id)
+        self._timer_countdown = (entity_id, handle)
+
+    def stop_timer_countdown(self):
+        if self._timer_countdown is not None:
+            apis.ha_api.cancel_timer(self._timer_countdown[1])
+            self._timer_countdown = None
+
+    def timer_countdown_callback(self, kwargs):
+        # the state change already sent the popup of a stopped timer
+        if apis.ha_api.get_entity(kwargs["entity_id"]).state != "active":
+            self.stop_timer_countdown()
+            return
+        self.generate_timer_detail_page(kwargs["entity_id"])
+
     def generate_timer_detail_page(self, entity_id, is_open_detail=False):
-        if isinstance(entity_id, dict):
-            entity_id = entity_id["entity_id"]
         entity = apis.ha_api.get_entity(entity_id)
         icon_color = self.get_entity_color(entity)
         if entity.state in ["idle", "paused"]:
@@ -1075,7 +1120,7 @@ class LuiPagesGen(object):
             label3  = ""
         else: #active
             editable = 0
-            apis.ha_api.run_in(self.generate_timer_detail_page, 1, entity_id=entity_id)
+            self.start_timer_countdown(entity_id)
             finishes_at = dp.parse(entity.attributes.get("finishes_at"))
             delta = finishes_at - datetime.datetime.now(datetime.timezone.utc)
             hours, remainder = divmod(delta.total_seconds(), 3600)
@@ -51,7 +51,7 @@ class NsPanelLovelaceUIManager(ad.ADBase):
         # Request Tasmota Driver Version
         updater.request_berry_driver_version()
 
-        LuiMqttListener(use_api, topic_recv, api_panel_name, api_device_id, self._controller, updater)
+        LuiMqttListener(use_api, topic_recv, api_panel_name, api_device_id, self._controller, updater, mqttsender)
 
         self.adapi.log(f'Started ({version})')
         
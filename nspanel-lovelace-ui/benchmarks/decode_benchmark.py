@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+# Measures how many websocket frames from Home Assistant the manager handles per
+# second, once decoding everything (like before) and once with the entity filter
+# that drops frames of unused entities before decoding them.
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "rootfs", "usr", "bin", "mqtt-manager"))
+import libs.home_assistant  # noqa: E402
+
+
+def make_state(entity_id, i):
+    return {
+        "entity_id": entity_id,
+        "state": str(i % 100),
+        "attributes": {
+            "unit_of_measurement": "W",
+            "device_class": "power",
+            "friendly_name": f"Sensor {i}",
+            "history": list(range(20)),
+        },
+        "last_changed": "2024-01-01T00:00:00.000000+00:00",
+        "last_updated": "2024-01-01T00:00:00.000000+00:00",
+        "context": {"id": "01HKZ7Y5Z6Q9", "parent_id": None, "user_id": None},
+    }
+
+
+def make_frames(entity_ids, count):
+    frames = []
+    for i in range(count):
+        entity_id = entity_ids[i % len(entity_ids)]
+        frames.append(json.dumps({
+            "id": 1,
+            "type": "event",
+            "event": {
+                "event_type": "state_changed",
+                "data": {
+                    "entity_id": entity_id,
+                    "old_state": make_state(entity_id, i),
+                    "new_state": make_state(entity_id, i + 1),
+                },
+                "origin": "LOCAL",
+                "time_fired": "2024-01-01T00:00:00.000000+00:00",
+                "context": {"id": "01HKZ7Y5Z6Q9", "parent_id": None, "user_id": None},
+            },
+        }))
+    return frames
+
+
+def run(name, frames, states_frame, entity_filter):
+    libs.home_assistant.entity_filter = entity_filter
+    libs.home_assistant.server_side_filter = False
+    libs.home_assistant.state_store.clear()
+    libs.home_assistant.request_all_states_id = 2
+
+    start = time.perf_counter()
+    libs.home_assistant.on_message(None, states_frame)
+    states_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for frame in frames:
+        libs.home_assistant.on_message(None, frame)
+    events_time = time.perf_counter() - start
+
+    print(f"{name:<10} get_states: {states_time * 1000:8.1f} ms  "
+          f"events: {len(frames) / events_time:10.0f} frames/s  "
+          f"cached states: {len(libs.home_assistant.state_store)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entities", type=int, default=5000, help="entities in Home Assistant")
+    parser.add_argument("--used", type=int, default=50, help="entities used by the panels")
+    parser.add_argument("--frames", type=int, default=20000, help="state_changed frames to process")
+    args = parser.parse_args()
+
+    entity_ids = [f"sensor.power_{i}" for i in range(args.entities)]
+    frames = make_frames(entity_ids, args.frames)
+    states_frame = json.dumps({
+        "id": 2,
+        "type": "result",
+        "success": True,
+        "result": [make_state(entity_id, i) for i, entity_id in enumerate(entity_ids)],
+    })
+    libs.home_assistant.init({"home_assistant_address": "", "home_assistant_token": ""}, lambda entity_id: None)
+
+    print(f"json backend: {libs.home_assistant.json_loads.__module__}")
+    run("all", frames, states_frame, None)
+    run("filtered", frames, states_frame, set(entity_ids[:args.used]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import resource
+import sys
+import time
+from datetime import datetime
+
+import websockets
+
+# Replays a state_changed stream from a local stand-in for Home Assistant to the
+# manager running with N panels and reports throughput, CPU time, memory and
+# the latency from sending an event until the first panel update showing it.
+#
+# The manager runs in this process with use_ha_api, so messages to the panels
+# come back to the stand-in as esphome service calls and no MQTT broker is
+# needed. The stand-in runs in its own process and isn't part of the CPU and
+# memory numbers. Every replayed state gets a "#r<seq>" suffix on its
+# friendly_name, that's how panel updates are matched to the events.
+#
+# A recording has one state_changed event per line, as received from
+# subscribe_events (the "event" object or the whole message). Its entities
+# are spread over the panels like the synthetic ones.
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "rootfs", "usr", "bin", "mqtt-manager"))
+
+TOKEN_PATTERN = re.compile(r"#r(\d+)")
+ENTITIES_PER_CARD = 4
+
+
+def make_state(entity_id, i):
+    return {
+        "entity_id": entity_id,
+        "state": str(i % 1000),
+        "attributes": {
+            "unit_of_measurement": "W",
+            "device_class": "power",
+            "friendly_name": f"Power {entity_id.split('_')[-1]}",
+        },
+        "last_changed": "2024-01-01T00:00:00.000000+00:00",
+        "last_updated": "2024-01-01T00:00:00.000000+00:00",
+        "context": {"id": "01HKZ7Y5Z6Q9", "parent_id": None, "user_id": None},
+    }
+
+
+def make_synthetic(entities, rate, duration):
+    # (offset in seconds, new state) at rate events per second
+    entity_ids = [f"sensor.bench_power_{i}" for i in range(entities)]
+    states = [make_state(entity_id, i) for i, entity_id in enumerate(entity_ids)]
+    rng = random.Random(1)
+    events = []
+    for i in range(int(rate * duration)):
+        events.append((i / rate, make_state(rng.choice(entity_ids), i)))
+    return states, events
+
+
+def load_recording(path):
+    states = {}
+    events = []
+    start = None
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            event = event.get("event", event)
+            if event.get("event_type") != "state_changed" or event["data"].get("new_state") is None:
+                continue
+            data = event["data"]
+            fired = datetime.fromisoformat(event["time_fired"]).timestamp()
+            if start is None:
+                start = fired
+            states.setdefault(data["entity_id"], data.get("old_state") or data["new_state"])
+            events.append((fired - start, data["new_state"]))
+    return list(states.values()), events
+
+
+def make_settings(port, panels, entity_ids, baud_rate, subscribe_all):
+    nspanels = {}
+    for i in range(panels):
+        # every panel starts on a different part of the entities
+        shift = i * ENTITIES_PER_CARD % len(entity_ids)
+        rotated = entity_ids[shift:] + entity_ids[:shift]
+        nspanels[f"bench_{i}"] = {
+            "panelRecvTopic": f"bench_device_{i}",
+            "panelSendTopic": f"bench_panel_{i}",
+            "timeFormat": "%H:%M",
+            "timeZone": "Europe/Berlin",
+            "dateFormat": "full",
+            "locale": "en_US",
+            "serialBaudRate": baud_rate,
+            "screensaver": {"entities": []},
+            "cards": [
+                {"type": "cardEntities", "title": f"Bench {i}.{n}",
+                 "entities": [{"entity": e} for e in rotated[n:n + ENTITIES_PER_CARD]]}
+                for n in range(0, len(rotated), ENTITIES_PER_CARD)
+            ],
+        }
+    return {
+        "home_assistant_address": f"http://127.0.0.1:{port}",
+        "home_assistant_token": "benchmark",
+        "is_addon": False,
+        "use_ha_api": True,
+        "subscribe_all_entities": subscribe_all,
+        "nspanels": nspanels,
+    }
+
+
+class FakeHomeAssistant:
+    # the part of the websocket API the manager uses
+
+    def __init__(self, states):
+        self.states = {state["entity_id"]: state for state in states}
+        self.clients = []
+        self.seq = itertools.count(1)
+        self.sent = {}
+        self.seen = set()
+        self.latencies = []
+        self.panel_messages = 0
+        self.last_message = 0
+
+    async def handler(self, websocket, *_):
+        client = {"ws": websocket, "state_changed": None, "panel_events": None, "entities": None, "entity_ids": set()}
+        self.clients.append(client)
+        try:
+            await websocket.send(json.dumps({"type": "auth_required", "ha_version": "2024.6.0"}))
+            async for message in websocket:
+                await self.handle(client, json.loads(message))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.clients.remove(client)
+
+    async def result(self, client, msg, result=None, success=True):
+        await client["ws"].send(json.dumps({"id": msg["id"], "type": "result", "success": success, "result": result}))
+
+    async def handle(self, client, msg):
+        msg_type = msg["type"]
+        if msg_type == "auth":
+            await client["ws"].send(json.dumps({"type": "auth_ok", "ha_version": "2024.6.0"}))
+        elif msg_type == "get_states":
+            await self.result(client, msg, list(self.states.values()))
+        elif msg_type == "subscribe_events":
+            if msg.get("event_type") == "esphome.nspanel.data":
+                client["panel_events"] = msg["id"]
+            else:
+                client["state_changed"] = msg["id"]
+            await self.result(client, msg)
+        elif msg_type == "subscribe_entities":
+            client["entities"] = msg["id"]
+            client["entity_ids"].update(msg["entity_ids"])
+            await self.result(client, msg)
+            added = {e: {"s": self.states[e]["state"], "a": self.states[e]["attributes"]}
+                     for e in msg["entity_ids"] if e in self.states}
+            await client["ws"].send(json.dumps({"id": msg["id"], "type": "event", "event": {"a": added}}))
+        elif msg_type == "render_template":
+            await self.result(client, msg)
+            event = {"result": msg["template"], "listeners": {"all": False, "domains": [], "entities": [], "time": False}}
+            await client["ws"].send(json.dumps({"id": msg["id"], "type": "event", "event": event}))
+        elif msg_type == "execute_script":
+            await self.result(client, msg, {"response": {}})
+        elif msg_type == "call_service" and msg["domain"] == "esphome":
+            self.on_panel_message(msg["service_data"]["data"])
+            await self.result(client, msg)
+        elif msg_type == "call_service":
+            # switch the called entities, like HA would
+            await self.result(client, msg)
+            entity_ids = msg.get("target", {}).get("entity_id", [])
+            for entity_id in [entity_ids] if isinstance(entity_ids, str) else entity_ids:
+                if entity_id in self.states:
+                    state = dict(self.states[entity_id])
+                    state["state"] = "off" if state["state"] == "on" else "on"
+                    await self.send_state(state)
+        else:
+            await self.result(client, msg)
+
+    def on_panel_message(self, data):
+        now = time.monotonic()
+        self.panel_messages += 1
+        self.last_message = now
+        for seq in TOKEN_PATTERN.findall(data):
+            seq = int(seq)
+            if seq in self.sent and seq not in self.seen:
+                self.seen.add(seq)
+                self.latencies.append(now - self.sent[seq])
+
+    async def send_state(self, state, seq=None):
+        entity_id = state["entity_id"]
+        if seq is not None:
+            state = dict(state)
+            attributes = dict(state["attributes"])
+            attributes["friendly_name"] = f"{attributes.get('friendly_name', entity_id)}#r{seq}"
+            state["attributes"] = attributes
+            self.sent[seq] = time.monotonic()
+        old_state = self.states.get(entity_id)
+        self.states[entity_id] = state
+        for client in list(self.clients):
+            if client["state_changed"] is not None:
+                event = {"event_type": "state_changed", "data": {"entity_id": entity_id, "old_state": old_state, "new_state": state},
+                         "origin": "LOCAL", "time_fired": datetime.now().astimezone().isoformat()}
+                await client["ws"].send(json.dumps({"id": client["state_changed"], "type": "event", "event": event}))
+            elif client["entities"] is not None and entity_id in client["entity_ids"]:
+                changes = {entity_id: {"+": {"s": state["state"], "a": state["attributes"]}}}
+                await client["ws"].send(json.dumps({"id": client["entities"], "type": "event", "event": {"c": changes}}))
+
+    async def panel_event(self, device_id, payload):
+        for client in list(self.clients):
+            if client["panel_events"] is not None:
+                event = {"event_type": "esphome.nspanel.data", "data": {"device_id": device_id, "CustomRecv": payload}}
+                await client["ws"].send(json.dumps({"id": client["panel_events"], "type": "event", "event": event}))
+
+    async def wake(self, device_ids):
+        # leave the screensaver, the panels show their first card then
+        for device_id in device_ids:
+            await self.panel_event(device_id, "event,startup,53,eu")
+            await self.panel_event(device_id, "event,buttonPress2,screensaver,bExit,2")
+        await asyncio.sleep(1)
+        return {"panel_messages": self.panel_messages}
+
+    async def replay(self, events, speed, settle):
+        self.sent.clear()
+        self.seen.clear()
+        self.latencies = []
+        self.panel_messages = 0
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for offset, state in events:
+            delay = start + offset / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.send_state(state, next(self.seq))
+        send_time = loop.time() - start
+        last_sent = time.monotonic()
+        # wait until the panels are quiet again
+        while time.monotonic() - max(self.last_message, last_sent) < settle:
+            await asyncio.sleep(0.05)
+        return {
+            "events": len(events),
+            "send_time": send_time,
+            "drain_time": max(0, self.last_message - last_sent),
+            "panel_messages": self.panel_messages,
+            "shown": len(self.seen),
+            "latencies": self.latencies,
+        }
+
+
+def run_server(conn, states):
+    # child process, answers the commands of the benchmark on conn
+    async def serve():
+        ha = FakeHomeAssistant(states)
+        loop = asyncio.get_running_loop()
+        async with websockets.serve(ha.handler, "127.0.0.1", 0, max_size=None) as server:
+            conn.send(server.sockets[0].getsockname()[1])
+            while True:
+                command = await loop.run_in_executor(None, conn.recv)
+                if command[0] == "stop":
+                    return
+                conn.send(await getattr(ha, command[0])(*command[1:]))
+    asyncio.run(serve())
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def rss_mb():
+    # current resident memory, /proc is Linux only
+    try:
+        with open("/proc/self/statm", "r", encoding="utf-8") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--panels", type=int, default=10, help="panels of the manager")
+    parser.add_argument("--entities", type=int, default=40, help="entities of the synthetic stream")
+    parser.add_argument("--rate", type=float, default=50, help="state changes per second of the synthetic stream at speed 1")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of the synthetic stream at speed 1")
+    parser.add_argument("--recording", help="replay state_changed events from this file instead")
+    parser.add_argument("--speeds", default="1,2,5,10", help="comma separated speed multipliers")
+    parser.add_argument("--baud", type=int, default=0, help="serialBaudRate of the panels, 0 doesn't pace the messages")
+    parser.add_argument("--subscribe-all", action="store_true", help="receive all states instead of subscribe_entities")
+    parser.add_argument("--settle", type=float, default=1, help="seconds without panel messages that end a run")
+    args = parser.parse_args()
+
+    if args.recording:
+        states, events = load_recording(args.recording)
+    else:
+        states, events = make_synthetic(args.entities, args.rate, args.duration)
+    entity_ids = [state["entity_id"] for state in states]
+
+    conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=run_server, args=(child_conn, states), daemon=True)
+    server.start()
+    port = conn.recv()
+
+    import libs.home_assistant  # noqa: E402
+    import main as manager  # noqa: E402
+    logging.getLogger().setLevel(logging.WARNING)
+    manager.settings = make_settings(port, args.panels, entity_ids, args.baud, args.subscribe_all)
+    rss_before = rss_mb()
+    start = time.monotonic()
+    manager.connect()
+    libs.home_assistant.prefetch_templates(manager.get_config_templates())
+    manager.setup_panels()
+    while len(manager.startup_times) < args.panels:
+        time.sleep(0.05)
+    print(f"{args.panels} panels, {len(entity_ids)} entities, {len(events)} events: "
+          f"started in {time.monotonic() - start:.2f} s, rss {rss_before:.1f} -> {rss_mb():.1f} MB")
+    conn.send(("wake", [settings_panel["panelRecvTopic"] for settings_panel in manager.settings["nspanels"].values()]))
+    conn.recv()
+
+    for speed in [float(s) for s in args.speeds.split(",")]:
+        cpu = time.process_time()
+        conn.send(("replay", events, speed, args.settle))
+        result = conn.recv()
+        cpu = time.process_time() - cpu
+        wall = result["send_time"] + result["drain_time"]
+        latencies = [latency * 1000 for latency in result["latencies"]]
+        print(f"speed {speed:5g}x  {result['events'] / wall:8.0f} events/s  "
+              f"panel msgs {result['panel_messages']:7d}  shown {result['shown']:6d}  "
+              f"cpu {cpu:6.2f} s ({cpu / wall * 100:3.0f} %)  rss {rss_mb():6.1f} MB  "
+              f"latency p50 {percentile(latencies, 50):6.1f} p95 {percentile(latencies, 95):6.1f} "
+              f"p99 {percentile(latencies, 99):6.1f} max {max(latencies, default=float('nan')):6.1f} ms  "
+              f"drain {result['drain_time'] * 1000:6.0f} ms")
+
+    print(f"peak rss {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    # the manager would log the closed connection
+    logging.getLogger().setLevel(logging.CRITICAL)
+    conn.send(("stop",))
+    server.join(5)
+
+
+if __name__ == '__main__':
+    main()
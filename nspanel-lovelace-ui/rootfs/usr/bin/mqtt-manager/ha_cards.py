@@ -1,46 +1,53 @@
 import libs.home_assistant
+import libs.countdown
+import libs.panel_cmd
 import ha_icons
 import ha_colors
 from libs.localization import get_translation
 import panel_cards
 import logging
 import dateutil.parser as dp
-import babel
+import babel.dates
 from libs.icon_mapping import get_icon_char
 from libs.helper import rgb_dec565, scale
-import time
-import threading
 import datetime
 import json
 
 class HAEntity(panel_cards.Entity):
     def __init__(self, locale, config, panel):
         super().__init__(locale, config, panel)
+        # resolve everything that only depends on the config once, render only
+        # reads the current state
+        self.icon_template = get_config_template(config, "icon")
+        self.color_template = get_config_template(config, "color")
+        self.value_template = self.value_overwrite if isinstance(self.value_overwrite, str) and self.value_overwrite.startswith("ha:") else None
+        self.status_entity = None
+        if self.etype == "navigate" and "status" in config:
+            self.status_entity = HAEntity(locale, {'entity': f'{config.get("status")}'}, panel)
+        self.entity_type_panel, self.render_value = VALUE_RENDERERS.get(self.etype, ("text", render_unsupported))
+        self.translations = {key: get_translation(locale, key) for key in STATIC_TRANSLATIONS.get(self.etype, [])}
 
     def prerender(self):
         # pre render templates
         for p in ["color_overwrite", "icon_overwrite", "value_overwrite"]:
             val = getattr(self, p)
             if val and "ha:" in val:
-                libs.home_assistant.cache_template(val)
+                self.panel.cache_template(val)
+
+    def get_templates(self):
+        return [t for t in [self.icon_template, self.color_template, self.value_template] if t]
 
     def render(self, cardType=""):
 
-        config_icon = self.config.get("icon", None)
-        if config_icon and isinstance(config_icon, str) and config_icon.startswith("ha:"):
-            self.icon_overwrite = libs.home_assistant.get_template(config_icon)
-        config_color = self.config.get("color", None)
-        if config_color and isinstance(config_color, str) and config_color.startswith("ha:"):
-            self.color_overwrite = json.loads(libs.home_assistant.get_template(config_color)[3:])
+        if self.icon_template:
+            self.icon_overwrite = libs.home_assistant.get_template(self.icon_template)
+        if self.color_template:
+            self.color_overwrite = json.loads(libs.home_assistant.get_template(self.color_template)[3:])
 
         if self.etype in ["delete", "navigate", "iText"]:
             out = super().render()
-            if self.etype == "navigate" and "status" in self.config:
-                status_out = HAEntity(self.locale,
-                                    {
-                                        'entity': f'{self.config.get("status")}',
-                                    }, self.panel
-                                ).render().split("~")
+            if self.status_entity:
+                status_out = self.status_entity.render().split("~")
                 status_out[2] = out.split("~")[2]
                 status_out = "~".join(status_out)
                 return status_out
@@ -57,7 +64,6 @@ class HAEntity(panel_cards.Entity):
             return "~text~iid.404~X~6666~not found~"
 
         # HA Entities
-        entity_type_panel = "text"
         icon_char = ha_icons.get_icon_ha(self.etype, self.state, device_class=self.attributes.get("device_class", None), media_content_type=self.attributes.get("media_content_type", None), overwrite=self.icon_overwrite)
 
         color = ha_colors.get_entity_color(self.etype, self.state, self.attributes, self.color_overwrite)
@@ -65,180 +71,210 @@ class HAEntity(panel_cards.Entity):
         name = self.config.get("name", self.attributes.get("friendly_name", "unknown"))
         if self.name_overwrite:
             name = self.name_overwrite
-        value = ""
-
-        match self.etype:
-            case 'switch' | 'input_boolean' | 'automation':
-                entity_type_panel = "switch"
-                value = 1 if self.state == "on" else 0
-            case 'lock':
-                entity_type_panel = "button"
-                value = get_translation(self.locale, "frontend.ui.card.lock.lock") if self.state == "unlocked" else get_translation(
-                    self.locale, "frontend.ui.card.lock.unlock")
-            case 'input_text':
-                value = self.state
-            case 'input_select' | 'select':
-                entity_type_panel = "input_sel"
-                value = self.state
-            case 'light':
-                entity_type_panel = "light"
-                value = 1 if self.state == "on" else 0
-            case 'fan':
-                entity_type_panel = "fan"
-                value = 1 if self.state == "on" else 0
-            case 'button' | 'input_button':
-                entity_type_panel = "button"
-                value = get_translation(
-                    self.locale, "frontend.ui.card.button.press")
-            case 'scene':
-                entity_type_panel = "button"
-                value = get_translation(
-                    self.locale, "frontend.ui.card.scene.activate")
-            case 'script':
-                entity_type_panel = "button"
-                value = get_translation(
-                    self.locale, "frontend.ui.card.script.run")
-            case 'number' | 'input_number':
-                entity_type_panel = "number"
-                min_v = self.attributes.get("min", 0)
-                max_v = self.attributes.get("max", 100)
-                value = f"{self.state}|{min_v}|{max_v}"
-            case 'timer':
-                entity_type_panel = "timer"
-                value = get_translation(
-                    self.locale, f"backend.component.timer.state._.{self.state}")
-            case 'alarm_control_panel':
-                value = get_translation(
-                    self.locale, f"frontend.state_badge.alarm_control_panel.{self.state}")
-            case 'vacuum':
-                entity_type_panel = "button"
-                if self.state == "docked":
-                    value = get_translation(
-                        self.locale, "frontend.ui.card.vacuum.actions.start_cleaning")
-                else:
-                    value = get_translation(
-                        self.locale, "frontend.ui.card.vacuum.actions.return_to_base")
-            case 'media_player':
-                entity_type_panel = "media_pl"
-                value = self.state
-            case 'sun':
-                value = get_translation(
-                    self.locale, f"backend.component.sun.state._.{self.state}")
-            case 'person':
-                value = get_translation(
-                    self.locale, f"backend.component.person.state._.{self.state}")
-            case 'climate':
-                # TODO: temp unit
-                temp_unit = "celsius"
-                state_value = get_translation(
-                    self.locale, f"backend.component.climate.state._.{self.state}")
-                temperature = self.attributes.get("temperature", "")
-                temperature_unit = "°C" if (temp_unit == "celsius") else "°F"
-                value = f"{state_value} {temperature}{temperature_unit}"
-                currently_tanslation = get_translation(
-                    self.locale, "frontend.ui.card.climate.currently")
-                current_temperature = self.attributes.get(
-                    "current_temperature", "")
-                value += f"\r\n{currently_tanslation}: {current_temperature}{temperature_unit}"
-            case 'cover':
-                entity_type_panel = "shutter"
-                device_class = self.attributes.get("device_class", "window")
-                icon_up = ""
-                icon_stop = ""
-                icon_down = ""
-                icon_up_status = "disable"
-                icon_stop_status = "disable"
-                icon_down_status = "disable"
-                bits = self.attributes.get("supported_features")
-                pos = self.attributes.get("current_position")
-                assumed_state = self.attributes.get("assumed_state", False)
-                if pos is None:
-                    pos = "disable"
-                if bits & 0b00000001:  # SUPPORT_OPEN
-                    if (pos != 100 and not (self.state == "open" and pos == "disable")):
-                        icon_up_status = "enable"
-                    icon_up = ha_icons.get_action_icon(
-                        etype=self.etype, action="open", device_class=device_class)
-                if bits & 0b00000010:  # SUPPORT_CLOSE
-                    if (pos != 0 and not (self.state == "closed" and pos == "disable")):
-                        icon_down_status = "enable"
-                    icon_down = ha_icons.get_action_icon(
-                        etype=self.etype, action="close", device_class=device_class)
-                if bits & 0b00001000:  # SUPPORT_STOP
-                    icon_stop = ha_icons.get_action_icon(
-                        etype=self.etype, action="stop", device_class=device_class)
-                    icon_stop_status = "enable"
-                if assumed_state:
-                    icon_up_status = "enable"
-                    icon_stop_status = "enable"
-                    icon_down_status = "enable"
-                value = f"{icon_up}|{icon_stop}|{icon_down}|{icon_up_status}|{icon_stop_status}|{icon_down_status}"
-            case 'sensor':
-                device_class = self.attributes.get("device_class", "")
-                unit_of_measurement = self.attributes.get("unit_of_measurement", "")
-                value = self.state
-                # limit value to 4 chars on us-p
-                if self.panel.model == "us-p" and cardType == "cardEntities":
-                    value = self.state[:4]
-                    if value[-1] == ".":
-                        value = value[:-1]
-
-                if device_class != "temperature":
-                    value = value + " "
-                value = value + unit_of_measurement
-                if cardType in ["cardGrid", "cardGrid2"] and not self.icon_overwrite:
-                    icon_char = value
-            case 'binary_sensor':
-                device_class = self.attributes.get("device_class", "")
-                value = get_translation(self.locale, f"backend.component.binary_sensor.state.{device_class}.{self.state}")
-            case 'weather':
-                attr = self.config.get("attribute", "temperature")
-                value = str(self.attributes.get(attr, self.state))
-
-                # settings for forecast
-                forecast_type = None
-                if self.config.get("day"):
-                    forecast_type = "daily"
-                    pos = self.config.get("day")
-                    datetime_format = "E"
-                if self.config.get("hour"):
-                    forecast_type = "hourly"
-                    pos = self.config.get("hour")
-                    datetime_format = "H:mm"
-                if forecast_type:
-                    forecast = libs.home_assistant.execute_script(
-                        entity_name=self.entity_id,
-                        domain='weather',
-                        service="get_forecasts",
-                        service_data={
-                            'type': forecast_type
-                        }
-                    ).get(self.entity_id,{}).get("forecast", [])
-                    if len(forecast) > pos:
-                        forcast_pos = forecast[pos]
-                        forcast_condition = forcast_pos.get("condition", "")
-                        forcast_date = dp.parse(forcast_pos.get("datetime")).astimezone()
-
-                        icon_char = ha_icons.get_icon_ha(self.etype, forcast_condition)
-                        name = babel.dates.format_datetime(forcast_date, datetime_format, locale=self.locale)
-
-                        attr = self.config.get("attribute", "temperature")
-                        value = str(forcast_pos.get(attr, "not found"))
-                    else:
-                        name: "unknown"
-                # add units
-                if attr in ["temperature", "apparent_temperature", "templow"]:
-                    value += self.config.get("unit", "°C")
-                else:
-                    value += self.config.get("unit", "")
-            case _:
-                name = "unsupported"
 
-        if self.value_overwrite and self.value_overwrite.startswith("ha:"):
-            value = libs.home_assistant.get_template(self.value_overwrite)[3:]
+        icon_char, name, value = self.render_value(self, cardType, icon_char, name)
+
+        if self.value_template:
+            value = libs.home_assistant.get_template(self.value_template)[3:]
+
+
+        return f"~{self.entity_type_panel}~iid.{self.iid}~{icon_char}~{color}~{name}~{value}"
+
+# config keys of cards and entities that can hold a "ha:" template, the
+# manager subscribes to these templates before the panels start
+QR_CODE_KEY = "qrCode"
+TEMPLATE_KEYS = ("icon", "color", "value", QR_CODE_KEY)
 
+def get_config_template(config, key):
+    val = config.get(key, None)
+    if val and isinstance(val, str) and val.startswith("ha:"):
+        return val
+    return None
 
-        return f"~{entity_type_panel}~iid.{self.iid}~{icon_char}~{color}~{name}~{value}"
+# translations that don't depend on the state, looked up once per entity
+STATIC_TRANSLATIONS = {
+    'lock': ["frontend.ui.card.lock.lock", "frontend.ui.card.lock.unlock"],
+    'button': ["frontend.ui.card.button.press"],
+    'input_button': ["frontend.ui.card.button.press"],
+    'scene': ["frontend.ui.card.scene.activate"],
+    'script': ["frontend.ui.card.script.run"],
+    'vacuum': ["frontend.ui.card.vacuum.actions.start_cleaning", "frontend.ui.card.vacuum.actions.return_to_base"],
+    'climate': ["frontend.ui.card.climate.currently"],
+}
+
+# render functions for the value of an entity, they get the entity, the card
+# type and the default icon and name and return icon, name and value
+def render_on_off(entity, cardType, icon_char, name):
+    return icon_char, name, 1 if entity.state == "on" else 0
+
+def render_state(entity, cardType, icon_char, name):
+    return icon_char, name, entity.state
+
+def render_lock(entity, cardType, icon_char, name):
+    key = "frontend.ui.card.lock.lock" if entity.state == "unlocked" else "frontend.ui.card.lock.unlock"
+    return icon_char, name, entity.translations[key]
+
+def render_button(entity, cardType, icon_char, name):
+    return icon_char, name, entity.translations["frontend.ui.card.button.press"]
+
+def render_scene(entity, cardType, icon_char, name):
+    return icon_char, name, entity.translations["frontend.ui.card.scene.activate"]
+
+def render_script(entity, cardType, icon_char, name):
+    return icon_char, name, entity.translations["frontend.ui.card.script.run"]
+
+def render_number(entity, cardType, icon_char, name):
+    min_v = entity.attributes.get("min", 0)
+    max_v = entity.attributes.get("max", 100)
+    return icon_char, name, f"{entity.state}|{min_v}|{max_v}"
+
+def render_state_translation(prefix):
+    def render(entity, cardType, icon_char, name):
+        return icon_char, name, get_translation(entity.locale, f"{prefix}.{entity.state}")
+    return render
+
+def render_vacuum(entity, cardType, icon_char, name):
+    if entity.state == "docked":
+        value = entity.translations["frontend.ui.card.vacuum.actions.start_cleaning"]
+    else:
+        value = entity.translations["frontend.ui.card.vacuum.actions.return_to_base"]
+    return icon_char, name, value
+
+def render_climate(entity, cardType, icon_char, name):
+    # TODO: temp unit
+    temp_unit = "celsius"
+    state_value = get_translation(
+        entity.locale, f"backend.component.climate.state._.{entity.state}")
+    temperature = entity.attributes.get("temperature", "")
+    temperature_unit = "°C" if (temp_unit == "celsius") else "°F"
+    value = f"{state_value} {temperature}{temperature_unit}"
+    currently_tanslation = entity.translations["frontend.ui.card.climate.currently"]
+    current_temperature = entity.attributes.get(
+        "current_temperature", "")
+    value += f"\r\n{currently_tanslation}: {current_temperature}{temperature_unit}"
+    return icon_char, name, value
+
+def render_cover(entity, cardType, icon_char, name):
+    device_class = entity.attributes.get("device_class", "window")
+    icon_up = ""
+    icon_stop = ""
+    icon_down = ""
+    icon_up_status = "disable"
+    icon_stop_status = "disable"
+    icon_down_status = "disable"
+    bits = entity.attributes.get("supported_features")
+    pos = entity.attributes.get("current_position")
+    assumed_state = entity.attributes.get("assumed_state", False)
+    if pos is None:
+        pos = "disable"
+    if bits & 0b00000001:  # SUPPORT_OPEN
+        if (pos != 100 and not (entity.state == "open" and pos == "disable")):
+            icon_up_status = "enable"
+        icon_up = ha_icons.get_action_icon(
+            etype=entity.etype, action="open", device_class=device_class)
+    if bits & 0b00000010:  # SUPPORT_CLOSE
+        if (pos != 0 and not (entity.state == "closed" and pos == "disable")):
+            icon_down_status = "enable"
+        icon_down = ha_icons.get_action_icon(
+            etype=entity.etype, action="close", device_class=device_class)
+    if bits & 0b00001000:  # SUPPORT_STOP
+        icon_stop = ha_icons.get_action_icon(
+            etype=entity.etype, action="stop", device_class=device_class)
+        icon_stop_status = "enable"
+    if assumed_state:
+        icon_up_status = "enable"
+        icon_stop_status = "enable"
+        icon_down_status = "enable"
+    return icon_char, name, f"{icon_up}|{icon_stop}|{icon_down}|{icon_up_status}|{icon_stop_status}|{icon_down_status}"
+
+def render_sensor(entity, cardType, icon_char, name):
+    device_class = entity.attributes.get("device_class", "")
+    unit_of_measurement = entity.attributes.get("unit_of_measurement", "")
+    value = entity.state
+    # limit value to 4 chars on us-p
+    if entity.panel.model == "us-p" and cardType == "cardEntities":
+        value = entity.state[:4]
+        if value[-1] == ".":
+            value = value[:-1]
+
+    if device_class != "temperature":
+        value = value + " "
+    value = value + unit_of_measurement
+    if cardType in ["cardGrid", "cardGrid2"] and not entity.icon_overwrite:
+        icon_char = value
+    return icon_char, name, value
+
+def render_binary_sensor(entity, cardType, icon_char, name):
+    device_class = entity.attributes.get("device_class", "")
+    return icon_char, name, get_translation(entity.locale, f"backend.component.binary_sensor.state.{device_class}.{entity.state}")
+
+def render_weather(entity, cardType, icon_char, name):
+    attr = entity.config.get("attribute", "temperature")
+    value = str(entity.attributes.get(attr, entity.state))
+
+    # settings for forecast
+    forecast_type = None
+    if entity.config.get("day"):
+        forecast_type = "daily"
+        pos = entity.config.get("day")
+        datetime_format = "E"
+    if entity.config.get("hour"):
+        forecast_type = "hourly"
+        pos = entity.config.get("hour")
+        datetime_format = "H:mm"
+    if forecast_type:
+        forecast = libs.home_assistant.get_forecast(entity.entity_id, forecast_type)
+        if len(forecast) > pos:
+            forcast_pos = forecast[pos]
+            forcast_condition = forcast_pos.get("condition", "")
+            forcast_date = dp.parse(forcast_pos.get("datetime")).astimezone()
+
+            icon_char = ha_icons.get_icon_ha(entity.etype, forcast_condition)
+            name = babel.dates.format_datetime(forcast_date, datetime_format, locale=entity.locale)
+
+            attr = entity.config.get("attribute", "temperature")
+            value = str(forcast_pos.get(attr, "not found"))
+        else:
+            name: "unknown"
+    # add units
+    if attr in ["temperature", "apparent_temperature", "templow"]:
+        value += entity.config.get("unit", "°C")
+    else:
+        value += entity.config.get("unit", "")
+    return icon_char, name, value
+
+def render_unsupported(entity, cardType, icon_char, name):
+    return icon_char, "unsupported", ""
+
+# entity type on the panel and render function per HA domain
+VALUE_RENDERERS = {
+    'switch': ("switch", render_on_off),
+    'input_boolean': ("switch", render_on_off),
+    'automation': ("switch", render_on_off),
+    'lock': ("button", render_lock),
+    'input_text': ("text", render_state),
+    'input_select': ("input_sel", render_state),
+    'select': ("input_sel", render_state),
+    'light': ("light", render_on_off),
+    'fan': ("fan", render_on_off),
+    'button': ("button", render_button),
+    'input_button': ("button", render_button),
+    'scene': ("button", render_scene),
+    'script': ("button", render_script),
+    'number': ("number", render_number),
+    'input_number': ("number", render_number),
+    'timer': ("timer", render_state_translation("backend.component.timer.state._")),
+    'alarm_control_panel': ("text", render_state_translation("frontend.state_badge.alarm_control_panel")),
+    'vacuum': ("button", render_vacuum),
+    'media_player': ("media_pl", render_state),
+    'sun': ("text", render_state_translation("backend.component.sun.state._")),
+    'person': ("text", render_state_translation("backend.component.person.state._")),
+    'climate': ("text", render_climate),
+    'cover': ("shutter", render_cover),
+    'sensor': ("text", render_sensor),
+    'binary_sensor': ("text", render_binary_sensor),
+    'weather': ("text", render_weather),
+}
 
 class HACard(panel_cards.Card):
     def __init__(self, locale, config, panel):
@@ -252,14 +288,38 @@ class HACard(panel_cards.Card):
             for e in config.get("entities"):
                 entity = HAEntity(locale, e, panel)
                 self.entities.append(entity)
+        self.entity_ids = frozenset(self.get_entities())
+        self.nav = None
+        self.nav_titles = None
 
     def get_iid_entities(self):
-        return [(e.iid, e.entity_id) for e in self.entities]
+        return self.entities
 
     def get_entities(self):
-        return [e.entity_id for e in self.entities]
+        ent = [e.entity_id for e in self.entities]
+        # status entities of navigation items are rendered as well
+        ent.extend(e.config["status"] for e in self.entities if e.config.get("status"))
+        # changed template results are dispatched like entity updates
+        for e in self.entities:
+            ent.extend(e.get_templates())
+        return ent
 
     def gen_nav(self):
+        # the buttons only change if the title of a linked card changes,
+        # e.g. media and thermo cards take the friendly name on first render
+        titles = (self.get_nav_title(self.iid_prev), self.get_nav_title(self.iid_next))
+        if self.nav is None or titles != self.nav_titles:
+            self.nav = self.build_nav()
+            self.nav_titles = titles
+        return self.nav
+
+    def get_nav_title(self, card_iid):
+        if card_iid:
+            card = self.panel.searchCard(card_iid)
+            if card is not None:
+                return card.title
+
+    def build_nav(self):
         leftBtn = "delete~~~~~"
         if self.iid_prev:
             leftBtn = panel_cards.Entity(self.locale,
@@ -304,7 +364,7 @@ class EntitiesCard(HACard):
 class QRCard(HACard):
     def __init__(self, locale, config, panel):
         super().__init__(locale, config, panel)
-        self.qrcode = config.get("qrCode", "https://www.youtube.com/watch?v=dQw4w9WgXcQ")
+        self.qrcode = config.get(QR_CODE_KEY, "https://www.youtube.com/watch?v=dQw4w9WgXcQ")
     def render(self):
         if self.qrcode.startswith("ha:"):
             self.qrcode = libs.home_assistant.get_template(self.qrcode)[3:]
@@ -565,11 +625,6 @@ class UnlockCard(HACard):
 
 class Screensaver(HACard):
     def __init__(self, locale, config, panel):
-        super().__init__(locale, config, panel)
-
-        if not self.type:
-            self.type = "screensaver"
-
         self.statusIcon1 = None
         if "statusIcon1" in config:
             self.statusIcon1 = HAEntity(locale, config.get("statusIcon1"), panel)
@@ -577,14 +632,22 @@ class Screensaver(HACard):
         if "statusIcon2" in config:
             self.statusIcon2 = HAEntity(locale, config.get("statusIcon2"), panel)
 
+        super().__init__(locale, config, panel)
+
+        if not self.type:
+            self.type = "screensaver"
+
     def get_entities(self):
-        ent = [e.entity_id for e in self.entities]
-        if self.statusIcon1:
-            ent.append(self.statusIcon1.entity_id)
-        if self.statusIcon2:
-            ent.append(self.statusIcon2.entity_id)
+        ent = super().get_entities()
+        for icon in [self.statusIcon1, self.statusIcon2]:
+            if icon:
+                ent.append(icon.entity_id)
+                ent.extend(icon.get_templates())
         return ent
 
+    def get_iid_entities(self):
+        return [*self.entities, *(icon for icon in [self.statusIcon1, self.statusIcon2] if icon)]
+
     def render(self):
         result = ""
         for e in self.entities:
@@ -832,14 +895,11 @@ def detail_open(locale, detail_type, ha_entity_id, entity_id, msg_out_queue, sen
             else: #active
                 editable = 0
 
-                #update timer in a second
+                #update timer every second while the popup is open
                 def update_time():
-                    time.sleep(1)
                     out = detail_open(locale, detail_type, ha_entity_id, entity_id, msg_out_queue, sendTopic=sendTopic)
                     libs.panel_cmd.entityUpdateDetail(msg_out_queue, sendTopic, out)
-                tt = threading.Thread(target=update_time, args=())
-                tt.daemon = True
-                tt.start()
+                libs.countdown.start(sendTopic, ha_entity_id, update_time)
 
                 finishes_at = dp.parse(attributes.get("finishes_at"))
                 delta = finishes_at - datetime.datetime.now(datetime.timezone.utc)
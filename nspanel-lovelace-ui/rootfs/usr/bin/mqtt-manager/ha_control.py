@@ -1,14 +1,22 @@
 import libs.home_assistant
 import logging
-import time
 from libs.helper import pos_to_color, scale
 
-def wait_for_ha_cache():
-    mustend = time.time() + 5
-    while time.time() < mustend:
-        if len(libs.home_assistant.home_assistant_entity_state_cache) == 0:
-            time.sleep(0.1)
-    time.sleep(1)
+def wait_for_ha_cache(timeout=5):
+    # returns False if HA didn't send the states within timeout
+    return libs.home_assistant.states_ready.wait(timeout)
+
+def get_dim_entities(sleepTracking, sleepBrightness, screenBrightness, sleepOverride):
+    # all entities that calculate_dim_values may depend on
+    entities = []
+    for brightness in [sleepBrightness, screenBrightness]:
+        if isinstance(brightness, str) and not brightness.startswith("ha:"):
+            entities.append(brightness)
+    if sleepTracking:
+        entities.append(sleepTracking)
+    if sleepOverride and isinstance(sleepOverride, dict) and sleepOverride.get("entity"):
+        entities.append(sleepOverride.get("entity"))
+    return entities
 
 def calculate_dim_values(sleepTracking, sleepTrackingZones, sleepBrightness, screenBrightness, sleepOverride, return_involved_entities=False):
     dimmode = 10
@@ -0,0 +1,88 @@
+import datetime
+import logging
+import threading
+from dateutil import tz
+import babel.dates
+import libs.runtime
+
+# one clock for all panels, time and date strings are formatted once per
+# group of panels with the same settings and sent to every panel of the group
+_time_groups = {}
+_date_groups = {}
+_timezones = {}
+_lock = threading.Lock()
+_started = False
+_last_minute = None
+
+
+def get_timezone(name):
+    if name not in _timezones:
+        _timezones[name] = tz.gettz(name)
+    return _timezones[name]
+
+
+def format_time(timezone, time_format):
+    return datetime.datetime.now(get_timezone(timezone)).strftime(time_format)
+
+
+def format_date(locale, date_format):
+    return babel.dates.format_date(datetime.datetime.now(), date_format, locale=locale)
+
+
+def register_time(timezone, time_format, callback):
+    # callback gets the formatted time every minute
+    with _lock:
+        _time_groups.setdefault((timezone, time_format), []).append(callback)
+    _start()
+
+
+def register_date(locale, date_format, callback):
+    # callback gets the formatted date every hour
+    with _lock:
+        _date_groups.setdefault((locale, date_format), []).append(callback)
+    _start()
+
+
+def unregister(callback):
+    with _lock:
+        for groups in [_time_groups, _date_groups]:
+            for key, callbacks in list(groups.items()):
+                if callback in callbacks:
+                    callbacks.remove(callback)
+                if not callbacks:
+                    del groups[key]
+
+
+def _start():
+    global _started, _last_minute
+    with _lock:
+        if _started:
+            return
+        _started = True
+        _last_minute = datetime.datetime.now().replace(second=0, microsecond=0)
+    libs.runtime.call_every(1, _tick)
+
+
+def _tick():
+    global _last_minute
+    minute = datetime.datetime.now().replace(second=0, microsecond=0)
+    if minute == _last_minute:
+        return
+    new_hour = minute.hour != _last_minute.hour or minute.date() != _last_minute.date()
+    _last_minute = minute
+    with _lock:
+        time_groups = [(key, list(callbacks)) for key, callbacks in _time_groups.items()]
+        date_groups = [(key, list(callbacks)) for key, callbacks in _date_groups.items()]
+    for (timezone, time_format), callbacks in time_groups:
+        _send(format_time(timezone, time_format), callbacks)
+    if new_hour:
+        for (locale, date_format), callbacks in date_groups:
+            _send(format_date(locale, date_format), callbacks)
+
+
+def _send(value, callbacks):
+    for callback in callbacks:
+        try:
+            callback(value)
+        except Exception:  # pylint: disable=broad-exception-caught
+            logging.exception("Failed to send clock update")
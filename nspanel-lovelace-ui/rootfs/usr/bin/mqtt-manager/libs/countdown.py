@@ -0,0 +1,55 @@
+import logging
+import threading
+import libs.home_assistant
+import libs.runtime
+
+# one tick for all open timer popups, every panel that shows an active timer
+# gets the remaining time once per second until the popup is closed or the
+# timer isn't active anymore
+_popups = {}
+_lock = threading.Lock()
+# handle of the tick while popups are open
+_tick_handle = None
+
+
+def start(key, entity_id, callback):
+    # key identifies the panel, a panel shows at most one popup
+    global _tick_handle
+    with _lock:
+        if _popups.get(key, (None, None))[0] == entity_id:
+            return
+        _popups[key] = (entity_id, callback)
+        if _tick_handle is None:
+            _tick_handle = libs.runtime.call_every(1, _tick)
+
+
+def stop(key):
+    with _lock:
+        _popups.pop(key, None)
+        _stop_tick()
+
+
+def _stop_tick():
+    # called with _lock held, the tick ends with the last popup
+    global _tick_handle
+    if not _popups and _tick_handle is not None:
+        _tick_handle.cancel()
+        _tick_handle = None
+
+
+def _tick():
+    with _lock:
+        popups = list(_popups.items())
+    for key, (entity_id, callback) in popups:
+        state = libs.home_assistant.get_entity_data(entity_id)
+        if state is None or state.state != "active":
+            # the state change already sent the final popup content
+            with _lock:
+                if _popups.get(key, (None, None))[1] is callback:
+                    del _popups[key]
+                    _stop_tick()
+            continue
+        try:
+            callback()
+        except Exception:  # pylint: disable=broad-exception-caught
+            logging.exception("Failed to send countdown of %s", entity_id)
@@ -2,20 +2,80 @@ import websocket
 import ssl
 import logging
 import json
-from threading import Thread
+import re
+from threading import Thread, Lock, RLock, Event
+from concurrent.futures import Future
 import time
 import os
+from libs.state_store import StateStore
+from libs.metrics import Counter, Gauge, Histogram
+import libs.tracing
+
+# faster json parser if installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 home_assistant_url = ""
 home_assistant_token = ""
 settings = {}
 auth_ok = False
 next_id = 0
-request_all_states_id = 0
+request_all_states_id = None
 ws_connected = False
-home_assistant_entity_state_cache = {}
+# set while the websocket is open
+ws_open = Event()
+state_store = StateStore()
+# set once the first states arrived from HA
+states_ready = Event()
 template_cache = {}
-response_buffer = {}
+# entities to receive states for, None for all entities of HA
+entity_filter = None
+# False if HA can't filter (no subscribe_entities), states of other entities
+# are dropped here then
+server_side_filter = True
+# subscribe_entities subscriptions of the current connection
+entity_subscription_ids = set()
+ENTITY_ID_PATTERN = re.compile(r"^\w+\.\w+$")
+# to find out what a frame is about without decoding all of it
+STATE_CHANGED_PEEK = re.compile(r'"event_type":\s*"state_changed",\s*"data":\s*\{\s*"entity_id":\s*"([^"]+)"')
+RESULT_LIST_PEEK = re.compile(r'^\{\s*"id":\s*(\d+),\s*"type":\s*"result",\s*"success":\s*true,\s*"result":\s*\[')
+PEEK_LENGTH = 300
+json_decoder = json.JSONDecoder()
+# frames dropped without decoding them
+discarded_frames = 0
+# requests waiting for a result, id -> Future
+pending_requests = {}
+# requests without a result yet, id -> (send time, type)
+request_starts = {}
+# render_template subscriptions, id -> template
+template_subscriptions = {}
+# one subscription per template shared by all users, template -> id
+template_ids = {}
+# number of cards/entities using a template, template -> count
+template_users = {}
+# set as soon as the first result of a template arrived
+template_events = {}
+# HA expects increasing ids, so ids are assigned and sent under this lock
+send_lock = RLock()
+pending_lock = Lock()
+# weather forecasts shared by all panels, (entity_id, forecast type) -> (fetch time, forecast)
+forecast_cache = {}
+# forecasts currently requested, (entity_id, forecast type) -> (request time, request id)
+forecast_requests = {}
+forecast_lock = Lock()
+
+FRAMES = Counter("nspanel_ws_frames_total", "Websocket frames received from Home Assistant")
+Counter("nspanel_ws_frames_discarded_total", "Frames of unused entities dropped before decoding",
+        lambda: {(): discarded_frames})
+Gauge("nspanel_states", "Entity states in the state store", lambda: {(): len(state_store)})
+TEMPLATE_LOOKUPS = Counter("nspanel_template_lookups_total", "Template results read by the panels")
+FORECAST_LOOKUPS = Counter("nspanel_forecast_lookups_total", "Weather forecasts read by the panels")
+REQUEST_SECONDS = Histogram("nspanel_ha_request_seconds", "Round trip of requests to Home Assistant")
+FORECAST_CACHE_TTL = 15*60
+FORECAST_REQUEST_TIMEOUT = 10
 
 
 ON_CONNECT_HANDLER = None
@@ -45,43 +105,82 @@ def register_on_disconnect_handler(handler):
 
 
 def on_message(ws, message):
-    global auth_ok, request_all_states_id, home_assistant_entity_state_cache, response_buffer, template_cache
-    json_msg = json.loads(message)
+    global auth_ok, request_all_states_id, template_cache, discarded_frames
+    FRAMES.inc()
+    if entity_filter is not None:
+        match = STATE_CHANGED_PEEK.search(message, 0, PEEK_LENGTH)
+        if match and match.group(1) not in entity_filter:
+            discarded_frames += 1
+            return
+    if request_all_states_id is not None:
+        match = RESULT_LIST_PEEK.match(message, 0, PEEK_LENGTH)
+        if match and int(match.group(1)) == request_all_states_id:
+            _pop_pending_request(request_all_states_id, "success")
+            _load_all_states(message, match.end())
+            return
+    json_msg = json_loads(message)
     if json_msg["type"] == "auth_required":
         authenticate_client()
     elif json_msg["type"] == "auth_ok":
         auth_ok = True
         logging.info("Home Assistant auth OK. Requesting existing states.")
-        subscribe_to_events()
-        _get_all_states()
+        entity_subscription_ids.clear()
+        if entity_filter is None or not server_side_filter:
+            subscribe_to_events()
+            _get_all_states()
+        elif entity_filter:
+            _subscribe_entities(entity_filter)
+        else:
+            # no entities to subscribe to, HA would send all for an empty list
+            _set_states_ready()
+        _resubscribe_templates()
         if ON_CONNECT_HANDLER is not None:
             ON_CONNECT_HANDLER()
     # for templates
-    elif json_msg["type"] == "event" and json_msg["id"] in response_buffer:
-        template_cache[response_buffer[json_msg["id"]]] = {
+    elif json_msg["type"] == "event" and json_msg["id"] in template_subscriptions:
+        template = template_subscriptions[json_msg["id"]]
+        previous = template_cache.get(template)
+        template_cache[template] = {
             "result": json_msg["event"]["result"],
             "listener-entities": json_msg["event"]["listeners"]["entities"]
         }
+        _get_template_event(template).set()
+        add_entities(json_msg["event"]["listeners"]["entities"])
+        # HA renders the template again on changes of its listener entities,
+        # panels subscribe to the template itself to get the new result
+        if previous is not None and previous.get("result") != json_msg["event"]["result"]:
+            send_entity_update(template)
+    elif json_msg["type"] == "event" and json_msg["id"] in entity_subscription_ids:
+        _on_entities_event(json_msg["event"])
     elif json_msg["type"] == "event" and json_msg["event"]["event_type"] == "state_changed":
         entity_id = json_msg["event"]["data"]["entity_id"]
-        home_assistant_entity_state_cache[entity_id] = json_msg["event"]["data"]["new_state"]
-        send_entity_update(entity_id)
-        # rerender template
-        for template, template_cache_entry in template_cache.items():
-            if entity_id in template_cache_entry.get("listener-entities", []):
-                cache_template(template)
+        new_state = json_msg["event"]["data"]["new_state"]
+        if new_state is None:
+            state_store.remove(entity_id)
+        else:
+            state_store.set(entity_id, new_state.get("state"), new_state.get("attributes", {}))
+        _on_state_changed(entity_id)
     elif json_msg["type"] == "event" and json_msg["event"]["event_type"] == "esphome.nspanel.data":
         nspanel_data_callback(json_msg["event"]["data"]["device_id"], json_msg["event"]["data"]["CustomRecv"])
     elif json_msg["type"] == "result" and not json_msg["success"]:
         logging.error("Failed result: ")
         logging.error(json_msg)
+        template = template_subscriptions.pop(json_msg["id"], None)
+        if template is not None:
+            template_ids.pop(template, None)
+        if json_msg["id"] in entity_subscription_ids:
+            _fallback_to_all_entities()
+        future = _pop_pending_request(json_msg["id"], "error")
+        if future:
+            future.set_exception(RuntimeError(json_msg.get("error")))
     elif json_msg["type"] == "result" and json_msg["success"]:
+        future = _pop_pending_request(json_msg["id"], "success")
         if json_msg["id"] == request_all_states_id:
             for entity in json_msg["result"]:
-                home_assistant_entity_state_cache[entity["entity_id"]] = entity
-        else:
-            if json_msg["id"] in response_buffer and json_msg.get("result"):
-                response_buffer[json_msg["id"]] = json_msg["result"]
+                state_store.set(entity["entity_id"], entity.get("state"), entity.get("attributes", {}))
+            _set_states_ready()
+        elif future:
+            future.set_result(json_msg.get("result"))
         return None  # Ignore success result messages
     else:
         logging.debug(message)
@@ -90,6 +189,7 @@ def on_message(ws, message):
 def _ws_connection_open(ws):
     global ws_connected
     ws_connected = True
+    ws_open.set()
     logging.info("WebSocket connection to Home Assistant opened.")
     if ON_CONNECT_HANDLER is not None:
         ON_CONNECT_HANDLER()
@@ -98,7 +198,19 @@ def _ws_connection_open(ws):
 def _ws_connection_close(ws, close_status_code, close_msg):
     global ws_connected
     ws_connected = False
+    ws_open.clear()
     logging.error("WebSocket connection closed!")
+    # subscriptions end with the connection, they are renewed after auth
+    with send_lock:
+        template_subscriptions.clear()
+        template_ids.clear()
+    # nobody will answer the pending requests anymore
+    with pending_lock:
+        futures = list(pending_requests.values())
+        pending_requests.clear()
+        request_starts.clear()
+    for future in futures:
+        future.set_exception(ConnectionError("WebSocket connection to Home Assistant closed"))
     if ON_DISCONNECT_HANDLER is not None:
         ON_DISCONNECT_HANDLER()
 
@@ -119,9 +231,9 @@ def _do_connection():
                                 on_open=_ws_connection_open, on_close=_ws_connection_close)
     while True:
         logging.info(F"Connecting to Home Assistant at {ws_url}")
-        ws.close()
-        time.sleep(1)
         ws.run_forever(sslopt={"cert_reqs": ssl.CERT_NONE})
+        ws.close()
+        # only reconnects wait
         time.sleep(10)
 
 
@@ -136,32 +248,119 @@ def authenticate_client():
 
 
 def subscribe_to_events():
-    global next_id
     msg = {
-        "id": next_id,
         "type": "subscribe_events",
         "event_type": "state_changed"
     }
-    send_message(json.dumps(msg))
+    send_request(msg)
 
 def subscribe_to_nspanel_events(nsp_callback):
-    global next_id, nspanel_data_callback
+    global nspanel_data_callback
     nspanel_data_callback = nsp_callback
     msg = {
-        "id": next_id,
         "type": "subscribe_events",
         "event_type": "esphome.nspanel.data"
     }
-    send_message(json.dumps(msg))
+    send_request(msg)
 
 def _get_all_states():
-    global next_id, request_all_states_id
+    global request_all_states_id
     msg = {
-        "id": next_id,
         "type": "get_states",
     }
-    request_all_states_id = next_id
-    send_message(json.dumps(msg))
+    with send_lock:
+        request_all_states_id = next_id
+        send_request(msg)
+
+def set_entity_filter(entity_ids):
+    # only receive states of these entities, has to be called before connect
+    global entity_filter
+    entity_filter = set(e for e in entity_ids if _is_entity_id(e))
+
+def _load_all_states(message, pos):
+    # decode the states one by one, states of entities no panel uses are
+    # dropped right away instead of keeping a list of all states
+    end = len(message)
+    while pos < end:
+        while message[pos] in " \t\r\n,":
+            pos += 1
+        if message[pos] == "]":
+            break
+        entity, pos = json_decoder.raw_decode(message, pos)
+        if entity_filter is None or entity["entity_id"] in entity_filter:
+            state_store.set(entity["entity_id"], entity.get("state"), entity.get("attributes", {}))
+    _set_states_ready()
+
+def _set_states_ready():
+    if not states_ready.is_set():
+        logging.info("Received %d states from Home Assistant.", len(state_store))
+        states_ready.set()
+
+def add_entities(entity_ids):
+    # receive states of these entities as well, used for entities that were
+    # not known from the config
+    if entity_filter is None:
+        return
+    with send_lock:
+        new_entities = set(e for e in entity_ids if _is_entity_id(e)) - entity_filter
+        if not new_entities:
+            return
+        entity_filter.update(new_entities)
+        if not (ws_connected and auth_ok):
+            return
+        if server_side_filter:
+            _subscribe_entities(new_entities)
+        elif any(e not in state_store for e in new_entities):
+            # states of these were dropped when all states were loaded
+            _get_all_states()
+
+def _is_entity_id(entity_id):
+    return isinstance(entity_id, str) and ENTITY_ID_PATTERN.match(entity_id) and not entity_id.startswith(("navigate.", "iText."))
+
+def _subscribe_entities(entity_ids):
+    msg = {
+        "type": "subscribe_entities",
+        "entity_ids": sorted(entity_ids)
+    }
+    with send_lock:
+        entity_subscription_ids.add(next_id)
+        try:
+            send_request(msg)
+        except Exception:
+            logging.exception("Failed to subscribe to entities.")
+
+def _fallback_to_all_entities():
+    # e.g. HA versions without subscribe_entities
+    global server_side_filter
+    logging.warning("Filtered entity subscription failed, receiving all states instead.")
+    with send_lock:
+        server_side_filter = False
+        entity_subscription_ids.clear()
+        subscribe_to_events()
+        _get_all_states()
+
+def _on_entities_event(event):
+    # compressed states: "a" added entities, "c" changes, "r" removed entities
+    for entity_id, state in event.get("a", {}).items():
+        state_store.set(entity_id, state.get("s"), state.get("a", {}))
+        _on_state_changed(entity_id)
+    for entity_id, diff in event.get("c", {}).items():
+        additions = diff.get("+", {})
+        state_store.update(entity_id, additions.get("s"), additions.get("a"), diff.get("-", {}).get("a"))
+        _on_state_changed(entity_id)
+    for entity_id in event.get("r", []):
+        state_store.remove(entity_id)
+        _on_state_changed(entity_id)
+    # the first event has the current states of all subscribed entities
+    _set_states_ready()
+
+def _on_state_changed(entity_id):
+    libs.tracing.state_changed(entity_id)
+    # weather entity changed, forecasts are probably outdated as well
+    if entity_id.startswith("weather."):
+        for key in [key for key in forecast_cache if key[0] == entity_id]:
+            _request_forecast(*key)
+    send_entity_update(entity_id)
 
 # Got new value from Home Assistant, send update to callback method
 def send_entity_update(entity_id):
@@ -173,10 +372,8 @@ def nspanel_data_callback(device_id, msg):
     nspanel_data_callback(device_id, msg)
 
 def call_service(entity_name: str, domain: str, service: str, service_data: dict) -> bool:
-    global next_id
     try:
         msg = {
-            "id": next_id,
             "type": "call_service",
             "domain": domain,
             "service": service,
@@ -185,121 +382,225 @@ def call_service(entity_name: str, domain: str, service: str, service_data: dict
                 "entity_id": entity_name
             },
         }
-        send_message(json.dumps(msg))
+        libs.tracing.service_called(entity_name)
+        send_request(msg)
         return True
     except Exception as e:
         logging.exception("Failed to call Home Assisatant service.")
         return False
 
 def send_msg_to_panel(service: str, service_data: dict) -> bool:
-    global next_id
     try:
         msg = {
-            "id": next_id,
             "type": "call_service",
             "domain": "esphome",
             "service": service,
             "service_data": service_data,
         }
-        send_message(json.dumps(msg))
+        send_request(msg)
         return True
     except Exception as e:
         logging.exception("Failed to call Home Assisatant service.")
         return False
 
-def execute_script(entity_name: str, domain: str, service: str, service_data: dict) -> str:
-    global next_id, response_buffer
-    try:
-        call_id = next_id
-        # request answer for this call
-        response_buffer[call_id] = True
-        msg = {
-            "id": call_id,
-            "type": "execute_script",
-            "sequence": [
-               {
-                   "service": f"{domain}.{service}",
-                   "data": service_data,
-                   "target": {
-                       "entity_id": [entity_name]
-                    },
-                   "response_variable": "service_result"
+def _script_msg(entity_name, domain, service, service_data):
+    return {
+        "type": "execute_script",
+        "sequence": [
+           {
+               "service": f"{domain}.{service}",
+               "data": service_data,
+               "target": {
+                   "entity_id": [entity_name]
                 },
-               {
-                   "stop": "done",
-                   "response_variable": "service_result"
-                }
-            ]
-        }
-        send_message(json.dumps(msg))
-        # busy waiting for response with a timeout of 0.4 seconds- maybe there's a better way of doing this
-        mustend = time.time() + 0.4
-        while time.time() < mustend:
-            if response_buffer[call_id] == True:
-                #print(f'loooooooooop {time.time()}')
-                time.sleep(0.0001)
-            else:
-                return response_buffer[call_id]["response"]
-        raise TimeoutError("Did not recive respose in time to HA script call")
-    except Exception as e:
-        logging.exception("Failed to call Home Assisatant script.")
-        return {}
+               "response_variable": "service_result"
+            },
+           {
+               "stop": "done",
+               "response_variable": "service_result"
+            }
+        ]
+    }
+
+def get_forecast(entity_id, forecast_type):
+    # never waits for HA, returns the cached forecast and requests a new one if
+    # it's missing or too old. Panels get an update of the weather entity as
+    # soon as the new forecast arrived.
+    key = (entity_id, forecast_type)
+    cached = forecast_cache.get(key)
+    if not cached or time.time() - cached[0] > FORECAST_CACHE_TTL:
+        FORECAST_LOOKUPS.inc(result="miss")
+        _request_forecast(entity_id, forecast_type)
+    else:
+        FORECAST_LOOKUPS.inc(result="hit")
+    if cached:
+        return cached[1]
+    return []
+
+def _request_forecast(entity_id, forecast_type):
+    key = (entity_id, forecast_type)
+    now = time.time()
+    with forecast_lock:
+        requested = forecast_requests.get(key)
+        if requested is not None and now - requested[0] < FORECAST_REQUEST_TIMEOUT:
+            return
+        forecast_requests[key] = (now, None)
+    if requested is not None and requested[1] is not None:
+        # HA never answered the last request, forget it. The panels got the
+        # cached forecast meanwhile.
+        _pop_pending_request(requested[1], "timeout")
+    future = Future()
+    future.add_done_callback(lambda f: _on_forecast_result(key, f))
+    try:
+        call_id = send_request(_script_msg(entity_id, "weather", "get_forecasts", {"type": forecast_type}), future)
+    except Exception:
+        logging.exception("Failed to request weather forecast.")
+        with forecast_lock:
+            forecast_requests.pop(key, None)
+        return
+    with forecast_lock:
+        # unless the result arrived already
+        if forecast_requests.get(key) == (now, None):
+            forecast_requests[key] = (now, call_id)
+
+def _on_forecast_result(key, future):
+    with forecast_lock:
+        forecast_requests.pop(key, None)
+    if future.exception():
+        logging.error("Failed to get weather forecast for %s: %s", key[0], future.exception())
+        return
+    result = future.result() or {}
+    forecast = result.get("response", {}).get(key[0], {}).get("forecast", [])
+    forecast_cache[key] = (time.time(), forecast)
+    send_entity_update(key[0])
 
 def cache_template(template):
+    # subscribes to template, call release_template if it's not used anymore
     if not template:
         raise Exception("Invalid template")
-    global next_id, response_buffer
-    try:
+    with send_lock:
+        template_users[template] = template_users.get(template, 0) + 1
+        if template in template_ids:
+            return True
+        return _subscribe_template(template)
+
+def prefetch_templates(templates):
+    # subscribe to the templates of all panels at once, before the panels
+    # need them. They are released once the last panel using them is gone.
+    with send_lock:
+        for template in templates:
+            template_users.setdefault(template, 0)
+            if auth_ok and template not in template_ids:
+                _subscribe_template(template)
+
+def release_template(template):
+    with send_lock:
+        users = template_users.get(template, 0) - 1
+        if users > 0:
+            template_users[template] = users
+            return
+        template_users.pop(template, None)
+        template_cache.pop(template, None)
+        with pending_lock:
+            template_events.pop(template, None)
+        call_id = template_ids.pop(template, None)
+        if call_id is None:
+            return
+        template_subscriptions.pop(call_id, None)
+        try:
+            send_request({
+                "type": "unsubscribe_events",
+                "subscription": call_id
+            })
+        except Exception as e:
+            logging.exception("Failed to unsubscribe template.")
+
+def _subscribe_template(template):
+    msg = {
+        "type": "render_template",
+        "template": template
+    }
+    with send_lock:
         call_id = next_id
-        response_buffer[call_id] = template
-        msg = {
-            "id": call_id,
-            "type": "render_template",
-            "template": template
-        }
-        send_message(json.dumps(msg))
-        return True
-    except Exception as e:
-        logging.exception("Failed to render template.")
-        return False
+        template_subscriptions[call_id] = template
+        template_ids[template] = call_id
+        _get_template_event(template)
+        try:
+            send_request(msg)
+            return True
+        except Exception as e:
+            template_subscriptions.pop(call_id, None)
+            template_ids.pop(template, None)
+            logging.exception("Failed to render template.")
+            return False
+
+def _resubscribe_templates():
+    with send_lock:
+        template_subscriptions.clear()
+        template_ids.clear()
+        for template in list(template_users):
+            _subscribe_template(template)
+
+def _get_template_event(template):
+    with pending_lock:
+        return template_events.setdefault(template, Event())
+
+def _wait_for_template(template, timeout=0.5):
+    if template not in template_cache:
+        _get_template_event(template).wait(timeout)
+    return template_cache.get(template)
 
 def get_template(template):
-    global template_cache
-    if template in template_cache:
-        return template_cache[template].get("result")
-    else:
-        mustend = time.time() + 0.5
-        while time.time() < mustend:
-            if template not in template_cache:
-                time.sleep(0.0001)
-            else:
-                return template_cache.get(template, []).get("result", "404")
+    TEMPLATE_LOOKUPS.inc(result="hit" if template in template_cache else "miss")
+    template_entry = _wait_for_template(template)
+    if template_entry is not None:
+        return template_entry.get("result", "404")
 
 def get_template_listener_entities(template):
-    global template_cache
-    if template in template_cache:
-        return template_cache[template].get("listener-entities")
-    else:
-        mustend = time.time() + 0.5
-        while time.time() < mustend:
-            if template not in template_cache:
-                time.sleep(0.0001)
-            else:
-                return template_cache.get(template, []).get("listener-entities", "404")
+    template_entry = _wait_for_template(template)
+    if template_entry is not None:
+        return template_entry.get("listener-entities", "404")
 
 def get_entity_data(entity_id: str):
-    if entity_id in home_assistant_entity_state_cache:
-        return home_assistant_entity_state_cache[entity_id]
+    if entity_id in state_store:
+        return state_store.get(entity_id)
     else:
         return None
 def is_existent(entity_id: str):
-    if entity_id in home_assistant_entity_state_cache:
+    if entity_id in state_store:
         return True
     else:
         return False
 
 
+def _pop_pending_request(call_id, result=None):
+    # with a result ("success", "error" or "timeout") the round trip is recorded
+    with pending_lock:
+        started = request_starts.pop(call_id, None)
+        future = pending_requests.pop(call_id, None)
+    if started is not None and result is not None:
+        REQUEST_SECONDS.observe(time.monotonic() - started[0], type=started[1], result=result)
+    return future
+
+def send_request(msg, future=None):
+    # adds the next id to the message, the result will be set on future
+    global next_id
+    with send_lock:
+        call_id = next_id
+        msg["id"] = call_id
+        with pending_lock:
+            request_starts[call_id] = (time.monotonic(), msg["type"])
+            if future is not None:
+                pending_requests[call_id] = future
+        try:
+            send_message(json.dumps(msg))
+        except Exception:
+            _pop_pending_request(call_id)
+            raise
+        return call_id
+
 def send_message(message):
     global ws, next_id
-    next_id += 1
-    ws.send(message)
+    with send_lock:
+        next_id += 1
+        ws.send(message)
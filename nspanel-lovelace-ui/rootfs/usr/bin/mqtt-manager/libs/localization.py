@@ -1,5 +1,6 @@
 import os
 import json
+from functools import lru_cache
 
 
 def build_locale_filestring(locale):
@@ -23,21 +24,30 @@ def build_locale_filestring(locale):
     return path_frontend_file, path_backend_file
 
 
-def lookup(path_frontend_file, path_backend_file, lookupstr):
+@lru_cache(maxsize=8)
+def load_translations(path_frontend_file, path_backend_file):
+    # files are only read once, the last few locales stay in memory
     if not (os.path.exists(path_frontend_file) and os.path.exists(path_backend_file)):
-        return "error_fnf"
+        return None
     with open(path_frontend_file, 'r') as f, open(path_backend_file, 'r') as b:
-        translations = {"frontend": json.load(f), "backend": json.load(b)}
-        res = translations
-        for k in lookupstr.split("."):
-            if k in res:
-                res = res[k]
-        if type(res) is not str:
-            # res = "error_tnf"
-            res = lookupstr.split(".")[-1]
-        return res
+        return {"frontend": json.load(f), "backend": json.load(b)}
+
+
+def lookup(path_frontend_file, path_backend_file, lookupstr):
+    translations = load_translations(path_frontend_file, path_backend_file)
+    if translations is None:
+        return "error_fnf"
+    res = translations
+    for k in lookupstr.split("."):
+        if k in res:
+            res = res[k]
+    if type(res) is not str:
+        # res = "error_tnf"
+        res = lookupstr.split(".")[-1]
+    return res
 
 
+@lru_cache(maxsize=4096)
 def get_translation(locale, lookupstr):
     path_frontend_file, path_backend_file = build_locale_filestring(locale)
     res = lookup(path_frontend_file, path_backend_file, lookupstr)
@@ -0,0 +1,275 @@
+import asyncio
+import collections
+import logging
+import threading
+import time
+from libs.metrics import Counter
+from libs.panel_cmd import DEDUPLICATED_COMMANDS, PAGE_COMMANDS
+
+# priority of messages to the panels, lower is sent first
+INTERACTIVE, DETAIL, BACKGROUND = range(3)
+OUTBOX_PRIORITIES = {
+    "pageType": INTERACTIVE,
+    "entityUpd": INTERACTIVE,
+    "entityUpdateDetail": DETAIL,
+    "entityUpdateDetail2": DETAIL,
+    "timeout": DETAIL,
+    "dimmode": DETAIL,
+    "time": BACKGROUND,
+    "date": BACKGROUND,
+    "weatherUpdate": BACKGROUND,
+    "statusUpdate": BACKGROUND,
+}
+# a queued message of these commands is outdated by a newer one
+SUPERSEDED_COMMANDS = frozenset(DEDUPLICATED_COMMANDS + ["pageType", "timeout"])
+# 0x55 0xBB, payload length and CRC16 around each command on the panel UART
+FRAME_OVERHEAD = 6
+
+SENT_MESSAGES = Counter("nspanel_outbound_messages_total", "Messages sent to the panels")
+SENT_BYTES = Counter("nspanel_outbound_bytes_total", "Bytes sent to the panels, without framing")
+
+
+class SerialBudget:
+    # Token bucket of the UART between Tasmota/ESPHome and the display,
+    # tokens are bytes. capacity is the serial buffer of the display, a burst
+    # up to it is fine, anything more has to wait until it was transmitted.
+
+    def __init__(self, bytes_per_second, capacity):
+        self.bytes_per_second = bytes_per_second
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._waiting = False
+        self._wait_start = 0
+        self.throttled = 0
+        self.throttled_seconds = 0
+
+    def get_delay(self, size, now):
+        # seconds until a frame of size bytes can be sent
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.bytes_per_second)
+        self._updated = now
+        # frames larger than the buffer are sent once it's empty
+        missing = min(size, self.capacity) - self._tokens
+        if missing <= 0:
+            return 0
+        if not self._waiting:
+            self._waiting = True
+            self._wait_start = now
+        return missing / self.bytes_per_second
+
+    def consume(self, size, now):
+        self._tokens -= size
+        if self._waiting:
+            self._waiting = False
+            self.throttled += 1
+            self.throttled_seconds += now - self._wait_start
+
+
+class PanelInbox:
+    # Inbox of a panel thread. put never blocks, so the websocket and MQTT
+    # threads can't be stalled by a slow panel.
+    # HA updates only carry the entity_id and the panel reads the current state
+    # from the cache, so a pending update for the same entity is enough while
+    # the panel is busy. Messages from the panel are kept in order and the
+    # oldest one is dropped if more than max_messages are waiting.
+
+    def __init__(self, name, max_messages=50):
+        self.name = name
+        self.max_messages = max_messages
+        self._cond = threading.Condition()
+        self._items = collections.deque()
+        self._pending_entities = set()
+        # set by attach_loop if the panel runs as task on an event loop
+        self._loop = None
+        self._wakeup = None
+        self._message_count = 0
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def put(self, item):
+        kind, payload = item
+        with self._cond:
+            self.received += 1
+            if kind == "HA:":
+                if payload in self._pending_entities:
+                    self.coalesced += 1
+                    return
+                self._pending_entities.add(payload)
+            else:
+                if self._message_count >= self.max_messages:
+                    self._drop_oldest_message()
+                self._message_count += 1
+            self._items.append(item)
+            self._cond.notify()
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def get(self, timeout=None):
+        # returns None if nothing arrived within timeout
+        with self._cond:
+            if not self._items and not self._cond.wait_for(lambda: self._items, timeout):
+                return None
+            item = self._items.popleft()
+            if item[0] == "HA:":
+                self._pending_entities.discard(item[1])
+            else:
+                self._message_count -= 1
+            return item
+
+    def attach_loop(self, loop):
+        with self._cond:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+
+    async def get_async(self, timeout=None):
+        # same as get, but waits on the event loop from attach_loop
+        self._wakeup.clear()
+        item = self.get(timeout=0)
+        if item is not None:
+            return item
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return self.get(timeout=0)
+
+    def _drop_oldest_message(self):
+        for item in self._items:
+            if item[0] != "HA:":
+                self._items.remove(item)
+                self._message_count -= 1
+                self.dropped += 1
+                logging.warning("Inbox of panel %s is full, dropped message %s", self.name, item[1])
+                return
+
+    def qsize(self):
+        return len(self._items)
+
+    def stats(self):
+        return {
+            "depth": len(self._items),
+            "received": self.received,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+        }
+
+
+class PanelOutbox:
+    # Messages to all panels, one lane per topic. get returns the most urgent
+    # message and takes turns between the panels, so background updates of
+    # one panel can't delay the page a user just opened on another.
+    # A queued message is dropped if a newer one of the same command is put,
+    # and a page change drops the queued content of the previous page, so
+    # put never blocks and a lane holds at most one message per command.
+    # Lanes with a serial budget are paced to the UART speed of the panel,
+    # messages that wait meanwhile are replaced by newer ones as well.
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._lanes = {}
+        self._budgets = {}
+        self._topics = collections.deque()
+        self._count = 0
+        self.received = 0
+        self.superseded = 0
+
+    def put(self, item):
+        topic, msg = item
+        command = msg.split("~", 1)[0]
+        with self._cond:
+            self.received += 1
+            lane = self._lanes.get(topic)
+            if lane is None:
+                lane = self._lanes[topic] = [collections.deque() for _ in range(BACKGROUND + 1)]
+                self._topics.append(topic)
+            if command == "pageType":
+                self._remove(lane, PAGE_COMMANDS)
+            if command in SUPERSEDED_COMMANDS:
+                self._remove(lane, [command])
+            lane[OUTBOX_PRIORITIES.get(command, INTERACTIVE)].append((command, item))
+            self._count += 1
+            self._cond.notify()
+
+    def set_serial_rate(self, topic, baud_rate, buffer_size=1024):
+        # 8N1 needs 10 bits per byte, baud_rate 0 disables pacing
+        with self._cond:
+            if baud_rate:
+                self._budgets[topic] = SerialBudget(baud_rate / 10, buffer_size)
+            else:
+                self._budgets.pop(topic, None)
+            self._cond.notify()
+
+    def remove_topic(self, topic):
+        # drops the lane, its queued messages and the budget of a removed panel
+        with self._cond:
+            lane = self._lanes.pop(topic, None)
+            if lane is not None:
+                self._count -= sum(len(messages) for messages in lane)
+                self._topics.remove(topic)
+            self._budgets.pop(topic, None)
+
+    def get(self, timeout=None):
+        # returns None if nothing can be sent within timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                delay = None
+                if self._count:
+                    item, delay = self._next(now)
+                    if item is not None:
+                        return item
+                if deadline is not None:
+                    if now >= deadline:
+                        return None
+                    delay = deadline - now if delay is None else min(delay, deadline - now)
+                self._cond.wait(delay)
+
+    def _next(self, now):
+        # most urgent message of a lane within its budget, otherwise the
+        # seconds until the first lane has enough budget again
+        delay = None
+        # lanes waiting for budget, their less urgent messages wait as well
+        blocked = set()
+        for priority in range(BACKGROUND + 1):
+            for _ in range(len(self._topics)):
+                topic = self._topics[0]
+                self._topics.rotate(-1)
+                messages = self._lanes[topic][priority]
+                if not messages or topic in blocked:
+                    continue
+                budget = self._budgets.get(topic)
+                size = len(messages[0][1][1].encode("utf-8"))
+                if budget is not None:
+                    lane_delay = budget.get_delay(size + FRAME_OVERHEAD, now)
+                    if lane_delay > 0:
+                        blocked.add(topic)
+                        delay = lane_delay if delay is None else min(delay, lane_delay)
+                        continue
+                    budget.consume(size + FRAME_OVERHEAD, now)
+                self._count -= 1
+                SENT_MESSAGES.inc(topic=topic)
+                SENT_BYTES.inc(size, topic=topic)
+                return messages.popleft()[1], None
+        return None, delay
+
+    def _remove(self, lane, commands):
+        for messages in lane:
+            outdated = [m for m in messages if m[0] in commands]
+            for m in outdated:
+                messages.remove(m)
+                self._count -= 1
+                self.superseded += 1
+
+    def qsize(self):
+        return self._count
+
+    def stats(self):
+        return {
+            "depth": self._count,
+            "received": self.received,
+            "superseded": self.superseded,
+            "throttled": sum(b.throttled for b in self._budgets.values()),
+            "throttled_seconds": round(sum(b.throttled_seconds for b in self._budgets.values()), 3),
+        }
@@ -1,9 +1,38 @@
 import logging
+import threading
+
+# commands that are only sent if the payload changed since the last one
+DEDUPLICATED_COMMANDS = ["entityUpd", "entityUpdateDetail", "entityUpdateDetail2", "statusUpdate", "weatherUpdate", "time", "date", "dimmode"]
+# commands showing content of the current page, the panel forgets them on page changes
+PAGE_COMMANDS = ["entityUpd", "entityUpdateDetail", "entityUpdateDetail2", "statusUpdate", "weatherUpdate"]
+
+last_sent = {}
+last_sent_lock = threading.Lock()
 
 def custom_send(msg_out_queue, topic, msg):
+    command = msg.split("~", 1)[0]
+    with last_sent_lock:
+        sent = last_sent.setdefault(topic, {})
+        if command in DEDUPLICATED_COMMANDS:
+            if sent.get(command) == msg:
+                logging.debug("Skipped unchanged Message to NsPanel (%s): %s", topic, msg)
+                return
+            sent[command] = msg
+        elif command == "pageType":
+            for c in PAGE_COMMANDS:
+                sent.pop(c, None)
     msg_out_queue.put((topic, msg))
     logging.debug("Sent Message to NsPanel (%s): %s", topic, msg)
 
+def invalidate(topic, commands=None):
+    # make sure the next message of these commands is sent even if unchanged
+    with last_sent_lock:
+        if commands is None:
+            last_sent.pop(topic, None)
+        else:
+            for c in commands:
+                last_sent.get(topic, {}).pop(c, None)
+
 
 def page_type(msg_out_queue, topic, target_page):
     if target_page == "cardUnlock":
@@ -0,0 +1,54 @@
+import logging
+import threading
+
+# event loop running all panels if use_asyncio is set, None for one thread per panel
+loop = None
+
+
+def call_later(delay, callback, *args):
+    # run callback once after delay seconds
+    if loop is not None:
+        loop.call_soon_threadsafe(loop.call_later, delay, _run, callback, args)
+        return
+    timer = threading.Timer(delay, _run, args=(callback, args))
+    timer.daemon = True
+    timer.start()
+
+
+class Repeat:
+    # returned by call_every, cancel() stops the calls
+    def __init__(self):
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+def call_every(interval, callback, *args):
+    # run callback every interval seconds until the returned handle is cancelled
+    handle = Repeat()
+    if loop is not None:
+        loop.call_soon_threadsafe(_repeat, handle, interval, callback, args)
+        return handle
+    def repeat_thread_target():
+        while not handle.cancelled.is_set():
+            _run(callback, args)
+            handle.cancelled.wait(interval)
+    thread = threading.Thread(target=repeat_thread_target)
+    thread.daemon = True
+    thread.start()
+    return handle
+
+
+def _repeat(handle, interval, callback, args):
+    if handle.cancelled.is_set():
+        return
+    loop.call_later(interval, _repeat, handle, interval, callback, args)
+    _run(callback, args)
+
+
+def _run(callback, args):
+    try:
+        callback(*args)
+    except Exception:  # pylint: disable=broad-exception-caught
+        logging.exception("Scheduled call of %s failed", callback)
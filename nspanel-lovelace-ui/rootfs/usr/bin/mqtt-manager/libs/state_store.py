@@ -0,0 +1,110 @@
+import sys
+import threading
+
+# attributes read by the renderers, all others are not stored
+RENDERED_ATTRIBUTES = frozenset([
+    "assumed_state", "brightness", "code_arm_required", "color_temp", "current_position",
+    "current_temperature", "current_tilt_position", "device_class", "duration", "effect",
+    "effect_list", "fan_mode", "fan_modes", "finishes_at", "friendly_name", "hvac_action",
+    "hvac_modes", "max", "max_mireds", "max_temp", "media_artist", "media_content_type",
+    "media_title", "min", "min_mireds", "min_temp", "open_sensors", "options", "percentage",
+    "percentage_step", "preset_mode", "preset_modes", "remaining", "rgb_color", "shuffle",
+    "source", "source_list", "supported_color_modes", "supported_features", "swing_mode",
+    "swing_modes", "target_temp_high", "target_temp_low", "target_temp_step", "temperature",
+    "unit_of_measurement", "volume_level",
+])
+
+
+class EntityState:
+    __slots__ = ("entity_id", "state", "attributes", "version")
+
+    def __init__(self, entity_id, state, attributes, version):
+        self.entity_id = entity_id
+        self.state = state
+        self.attributes = attributes
+        self.version = version
+
+    def get(self, key, default=None):
+        # callers used to get the state dict from HA
+        if key in ("entity_id", "state", "attributes"):
+            return getattr(self, key)
+        return default
+
+
+class StateStore:
+    # current states of HA entities. Records are replaced and never changed,
+    # so readers in other threads always see a complete state.
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+        self._extra_attributes = set()
+
+    def add_attributes(self, attributes):
+        # keep these attributes as well, e.g. from attribute keys in the config
+        self._extra_attributes.update(attributes)
+
+    def set(self, entity_id, state, attributes):
+        with self._lock:
+            self._set(entity_id, state, self._filter_attributes(attributes))
+
+    def update(self, entity_id, state=None, changed_attributes=None, removed_attributes=None):
+        # apply a diff, state None keeps the current state
+        with self._lock:
+            old = self._states.get(entity_id)
+            if old is None:
+                return
+            attributes = old.attributes
+            if changed_attributes or removed_attributes:
+                attributes = dict(attributes)
+                attributes.update(self._filter_attributes(changed_attributes or {}))
+                for attribute in removed_attributes or []:
+                    attributes.pop(attribute, None)
+            self._set(entity_id, old.state if state is None else state, attributes)
+
+    def remove(self, entity_id):
+        with self._lock:
+            self._states.pop(entity_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+
+    def get(self, entity_id):
+        return self._states.get(entity_id)
+
+    def get_version(self, entity_id):
+        # increases with every change of the entity, 0 if it doesn't exist
+        state = self._states.get(entity_id)
+        return state.version if state else 0
+
+    def __contains__(self, entity_id):
+        return entity_id in self._states
+
+    def __len__(self):
+        return len(self._states)
+
+    def memory_report(self):
+        states = list(self._states.values())
+        size = sys.getsizeof(self._states)
+        for state in states:
+            size += sys.getsizeof(state) + sys.getsizeof(state.attributes)
+            size += sum(sys.getsizeof(value) for value in state.attributes.values())
+        return {
+            "entities": len(states),
+            "attributes": sum(len(state.attributes) for state in states),
+            "bytes": size,
+        }
+
+    def _set(self, entity_id, state, attributes):
+        entity_id = sys.intern(entity_id)
+        if isinstance(state, str):
+            state = sys.intern(state)
+        old = self._states.get(entity_id)
+        self._states[entity_id] = EntityState(entity_id, state, attributes, old.version + 1 if old else 1)
+
+    def _filter_attributes(self, attributes):
+        return {
+            sys.intern(key): value for key, value in attributes.items()
+            if key in RENDERED_ATTRIBUTES or key in self._extra_attributes
+        }
@@ -0,0 +1,39 @@
+import threading
+
+# reverse index entity_id -> frozenset of subscriber keys (recv topic of the panel)
+# entries are replaced, never mutated, so lookups from the websocket thread need no lock
+_index = {}
+_subscriptions = {}
+_lock = threading.Lock()
+
+
+def subscribe(key, entity_ids):
+    # replace all subscriptions of key with entity_ids
+    with _lock:
+        _remove(key)
+        entity_ids = frozenset(e for e in entity_ids if e)
+        _subscriptions[key] = entity_ids
+        for entity_id in entity_ids:
+            _index[entity_id] = _index.get(entity_id, frozenset()) | {key}
+
+
+def unsubscribe(key):
+    with _lock:
+        _remove(key)
+
+
+def _remove(key):
+    for entity_id in _subscriptions.pop(key, ()):
+        subscribers = _index.get(entity_id, frozenset()) - {key}
+        if subscribers:
+            _index[entity_id] = subscribers
+        else:
+            _index.pop(entity_id, None)
+
+
+def get_subscribers(entity_id):
+    return _index.get(entity_id, ())
+
+
+def get_entities(key):
+    return _subscriptions.get(key, frozenset())
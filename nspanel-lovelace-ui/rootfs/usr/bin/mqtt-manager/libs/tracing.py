@@ -0,0 +1,139 @@
+import itertools
+import logging
+import threading
+import time
+from libs.metrics import Histogram
+
+# follows an event of a panel through the manager: received from MQTT/HA,
+# handled by the panel, service call to HA, state_changed of the called entity,
+# render of the page and the update handed to MQTT/HA. Each panel has at most
+# one open trace, a new event of the panel replaces it.
+STAGE_SECONDS = Histogram("nspanel_interaction_stage_seconds", "Time of a panel interaction since its previous stage")
+INTERACTION_SECONDS = Histogram("nspanel_interaction_seconds", "Time from a panel event until the panel was sent the result")
+
+# traces without a result are dropped after this many seconds
+TRACE_TIMEOUT = 10
+# commands that show the new state of an entity
+UPDATE_COMMANDS = ("entityUpd", "entityUpdateDetail", "entityUpdateDetail2")
+
+# log traces slower than this many seconds, None disables it
+slow_threshold = None
+
+_ids = itertools.count(1)
+# (recv topic, payload) -> time the event arrived
+_arrivals = {}
+# send topic -> open trace
+_traces = {}
+# entity_id -> trace waiting for its state_changed
+_waiting = {}
+_local = threading.local()
+_lock = threading.Lock()
+
+
+class Trace:
+    __slots__ = ("trace_id", "topic", "event", "entity_id", "stages")
+
+    def __init__(self, topic, event, received):
+        self.trace_id = next(_ids)
+        self.topic = topic
+        self.event = event
+        self.entity_id = None
+        self.stages = [("received", received)]
+
+    def mark(self, stage, now=None):
+        self.stages.append((stage, time.monotonic() if now is None else now))
+
+    def has(self, stage):
+        return any(name == stage for name, _ in self.stages)
+
+    def format(self):
+        start = self.stages[0][1]
+        return ", ".join(f"{name} +{(t - start) * 1000:.1f} ms" for name, t in self.stages)
+
+
+def received(recv_topic, payload):
+    with _lock:
+        # events the inbox dropped are never handled
+        if len(_arrivals) > 1000:
+            _arrivals.clear()
+        _arrivals[(recv_topic, payload)] = time.monotonic()
+
+
+def start(recv_topic, send_topic, payload):
+    # the panel handles payload in this thread now, service calls until
+    # stop() belong to this trace
+    now = time.monotonic()
+    with _lock:
+        trace = Trace(send_topic, payload, _arrivals.pop((recv_topic, payload), now))
+        trace.mark("handled", now)
+        old = _traces.get(send_topic)
+        if old is not None and old.entity_id is not None:
+            _waiting.pop(old.entity_id, None)
+        _traces[send_topic] = trace
+    _local.trace = trace
+    return trace
+
+
+def stop():
+    _local.trace = None
+
+
+def service_called(entity_id):
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        return
+    with _lock:
+        trace.entity_id = entity_id
+        trace.mark("service_called")
+        _waiting[entity_id] = trace
+
+
+def state_changed(entity_id):
+    if not _waiting:
+        return
+    with _lock:
+        trace = _waiting.pop(entity_id, None)
+        if trace is not None:
+            trace.mark("state_changed")
+
+
+def rendered(send_topic):
+    trace = _traces.get(send_topic)
+    if trace is None:
+        return
+    with _lock:
+        if trace.entity_id is None or trace.has("state_changed"):
+            if not trace.has("rendered"):
+                trace.mark("rendered")
+
+
+def published(send_topic, msg):
+    trace = _traces.get(send_topic)
+    if trace is None:
+        return
+    now = time.monotonic()
+    with _lock:
+        if _traces.get(send_topic) is not trace:
+            return
+        expired = now - trace.stages[0][1] > TRACE_TIMEOUT
+        # a service call waits for the update of the called entity
+        if not expired and trace.entity_id is not None and (
+                not trace.has("state_changed") or msg.split("~", 1)[0] not in UPDATE_COMMANDS):
+            return
+        del _traces[send_topic]
+        if trace.entity_id is not None:
+            _waiting.pop(trace.entity_id, None)
+    if expired:
+        logging.debug("Dropped trace %d of %s without result: %s", trace.trace_id, trace.event, trace.format())
+        return
+    trace.mark("published", now)
+    _finish(trace)
+
+
+def _finish(trace):
+    for (_, previous), (stage, t) in zip(trace.stages, trace.stages[1:]):
+        STAGE_SECONDS.observe(t - previous, stage=stage)
+    total = trace.stages[-1][1] - trace.stages[0][1]
+    INTERACTION_SECONDS.observe(total)
+    if slow_threshold is not None and total >= slow_threshold:
+        logging.warning("Slow interaction %d on %s (%s): %s", trace.trace_id, trace.topic, trace.event, trace.format())
@@ -1,45 +1,92 @@
 #!/usr/bin/env python
+import asyncio
 import logging
 import time
 import subprocess
 import libs.home_assistant
 import libs.panel_cmd
+import libs.runtime
+import libs.subscriptions
+import libs.tracing
+from libs.metrics import Counter, Gauge, start_server
 import yaml
-from panel import LovelaceUIPanel
+from ha_cards import TEMPLATE_KEYS
+from panel import LovelaceUIPanel, PANEL_TEMPLATE_KEYS
 import os
 import threading
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 import signal
 import sys
-from queue import Queue
 from mqtt import MqttManager
+from libs.message_bus import PanelInbox, PanelOutbox
 
 logging.getLogger("watchdog").propagate = False
 
 settings = {}
 panels = {}
 panel_in_queues = {}
-panel_out_queue = Queue(maxsize=20)
+panel_out_queue = PanelOutbox()
+mqtt_manager = None
+reload_lock = threading.Lock()
+# seconds from start until each panel was sent pageStartup
+start_time = time.monotonic()
+startup_times = {}
+startup_lock = threading.Lock()
 last_settings_file_mtime = 0
 mqtt_connect_time = 0
 has_sent_reload_command = False
 
 logging.basicConfig(level=logging.DEBUG)
 
+STATE_EVENTS = Counter("nspanel_state_events_total", "HA state changes by whether a panel uses the entity")
+Gauge("nspanel_inbox_depth", "Messages waiting in the inbox of a panel",
+      lambda: {(("panel", inbox.name),): inbox.qsize() for inbox in list(panel_in_queues.values())})
+Counter("nspanel_inbox_coalesced_total", "HA updates merged with a pending one for the same entity",
+        lambda: {(("panel", inbox.name),): inbox.coalesced for inbox in list(panel_in_queues.values())})
+Counter("nspanel_inbox_dropped_total", "Panel events dropped because the inbox was full",
+        lambda: {(("panel", inbox.name),): inbox.dropped for inbox in list(panel_in_queues.values())})
+Gauge("nspanel_outbox_depth", "Messages waiting to be sent to the panels", lambda: {(): panel_out_queue.qsize()})
+Counter("nspanel_outbox_superseded_total", "Queued messages replaced by a newer one",
+        lambda: {(): panel_out_queue.superseded})
+Counter("nspanel_outbox_throttled_total", "Messages that waited for serial budget",
+        lambda: {(): panel_out_queue.stats()["throttled"]})
+
+# changes of these settings need new connections, so they restart the manager
+RESTART_SETTINGS = [
+    "mqtt_server", "mqtt_port", "mqtt_username", "mqtt_password",
+    "home_assistant_address", "home_assistant_token",
+    "use_ha_api", "use_asyncio", "subscribe_all_entities",
+    "metrics_port", "metrics_address",
+]
+
 def on_ha_update(entity_id):
     global panel_in_queues
-    # send HA updates to all panels
-    for queue in panel_in_queues.values():
-        queue.put(("HA:", entity_id))
+    # send HA updates only to panels using this entity
+    subscribers = libs.subscriptions.get_subscribers(entity_id)
+    if subscribers:
+        STATE_EVENTS.inc(len(subscribers), result="dispatched")
+    else:
+        STATE_EVENTS.inc(result="unused")
+    for recv_topic in subscribers:
+        queue = panel_in_queues.get(recv_topic)
+        if queue:
+            queue.put(("HA:", entity_id))
 
 def on_ha_panel_event(device_id, msg):
     global panel_in_queues
 
     if device_id in panel_in_queues.keys():
         queue = panel_in_queues[device_id]
+        libs.tracing.received(device_id, msg)
         queue.put(("MQTT:", msg))
 
+def log_inbox_stats():
+    for inbox in panel_in_queues.values():
+        logging.debug("Inbox of panel %s: %s", inbox.name, inbox.stats())
+    logging.debug("Outbox: %s", panel_out_queue.stats())
+    logging.debug("State store: %s", libs.home_assistant.state_store.memory_report())
+
 def process_output_to_panel():
     while True:
         msg = panel_out_queue.get()
@@ -55,34 +102,97 @@ def process_output_to_panel():
             service = service,
             service_data = service_data
         )
+        libs.tracing.published(msg[0], msg[1])
 
 
 def connect():
-    global settings, panel_out_queue
+    global settings, panel_out_queue, mqtt_manager
     if "mqtt_server" in settings and not "use_ha_api" in settings:
-        MqttManager(settings, panel_out_queue, panel_in_queues)
+        mqtt_manager = MqttManager(settings, panel_out_queue, panel_in_queues)
     else:
         logging.info("MQTT values not configured, will not connect.")
 
     # MQTT Connected, start APIs if configured
     if settings["home_assistant_address"] != "" and settings["home_assistant_token"] != "":
         libs.home_assistant.init(settings, on_ha_update)
+        if not settings.get("subscribe_all_entities"):
+            libs.home_assistant.set_entity_filter(get_config_entities())
+        libs.home_assistant.state_store.add_attributes(get_config_attributes())
         libs.home_assistant.connect()
     else:
         logging.info("Home Assistant values not configured, will not connect.")
 
-    while not libs.home_assistant.ws_connected:
-        time.sleep(1)
+    libs.home_assistant.ws_open.wait()
     if settings.get("use_ha_api"):
         libs.home_assistant.subscribe_to_nspanel_events(on_ha_panel_event)
         send_to_panel_thread = threading.Thread(target=process_output_to_panel, args=())
         send_to_panel_thread.daemon = True
         send_to_panel_thread.start()
 
-def setup_panels():
-    global settings, panel_in_queues
-    # Create NsPanel object
-    for name, settings_panel in settings["nspanels"].items():
+def get_config_entities():
+    # all entities referenced in the config of any panel
+    entities = set()
+    def collect(config):
+        if isinstance(config, dict):
+            for key, value in config.items():
+                if key in ["entity", "status", "sleepTracking", "sleepBrightness", "screenBrightness"] and isinstance(value, str):
+                    entities.add(value)
+                else:
+                    collect(value)
+        elif isinstance(config, list):
+            for value in config:
+                collect(value)
+    collect(settings["nspanels"])
+    collect(settings.get("hiddenCards", []))
+    return entities
+
+def get_config_attributes():
+    # attributes shown because of attribute settings in the config
+    attributes = set()
+    def collect(config):
+        if isinstance(config, dict):
+            for key, value in config.items():
+                if key in ["attribute", "attr"] and isinstance(value, str):
+                    attributes.add(value)
+                else:
+                    collect(value)
+        elif isinstance(config, list):
+            for value in config:
+                collect(value)
+    collect(settings["nspanels"])
+    collect(settings.get("hiddenCards", []))
+    return attributes
+
+def get_config_templates():
+    # templates of all panels, see LovelaceUIPanel.cache_template
+    templates = set()
+    def collect(config):
+        if isinstance(config, dict):
+            for key, value in config.items():
+                if key in TEMPLATE_KEYS or key in PANEL_TEMPLATE_KEYS:
+                    if isinstance(value, str) and value.startswith("ha:"):
+                        templates.add(value)
+                else:
+                    collect(value)
+        elif isinstance(config, list):
+            for value in config:
+                collect(value)
+    collect(settings["nspanels"])
+    collect(settings.get("hiddenCards", []))
+    return templates
+
+def report_startup(name):
+    with startup_lock:
+        if len(startup_times) == len(settings["nspanels"]):
+            # startup is over, e.g. panel added by a config reload
+            return
+        startup_times[name] = time.monotonic() - start_time
+        logging.info("Panel %s started after %.2f s", name, startup_times[name])
+        if len(startup_times) == len(settings["nspanels"]):
+            logging.info("All %d panels started after %.2f s", len(startup_times), max(startup_times.values()))
+
+def apply_panel_defaults():
+    for settings_panel in settings["nspanels"].values():
         if "timeZone" not in settings_panel:
             settings_panel["timeZone"] = settings.get("timeZone", "Europe/Berlin")
         if "locale" not in settings_panel:
@@ -90,20 +200,163 @@ def setup_panels():
         if "hiddenCards" not in settings_panel:
             settings_panel["hiddenCards"] = settings.get("hiddenCards", [])
 
-        msg_in_queue = Queue(maxsize=20)
-        panel_in_queues[settings_panel["panelRecvTopic"]] = msg_in_queue
-        panel_thread = threading.Thread(target=panel_thread_target, args=(msg_in_queue, name, settings_panel, panel_out_queue))
-        panel_thread.daemon = True
-        panel_thread.start()
+def setup_panels():
+    global settings, panel_in_queues
+    # Create NsPanel object
+    apply_panel_defaults()
+    for name, settings_panel in settings["nspanels"].items():
+        panel_in_queues[settings_panel["panelRecvTopic"]] = PanelInbox(name)
+        set_serial_rate(settings_panel)
+
+    if settings.get("use_asyncio"):
+        # all panels as tasks on one event loop in a single thread
+        panels_thread = threading.Thread(target=asyncio.run, args=(run_panels_async(),))
+        panels_thread.daemon = True
+        panels_thread.start()
+        return
+
+    for name, settings_panel in settings["nspanels"].items():
+        start_panel(name, settings_panel)
+
+def set_serial_rate(settings_panel):
+    # pace messages to the UART of the display if serialBaudRate is set, e.g.
+    # 115200, the budget is only an estimate of what the firmware handles
+    panel_out_queue.set_serial_rate(
+        settings_panel["panelSendTopic"],
+        settings_panel.get("serialBaudRate", 0),
+        settings_panel.get("serialBufferSize", 1024),
+    )
+
+def start_panel(name, settings_panel):
+    msg_in_queue = panel_in_queues[settings_panel["panelRecvTopic"]]
+    if libs.runtime.loop is not None:
+        asyncio.run_coroutine_threadsafe(panel_task(msg_in_queue, name, settings_panel, panel_out_queue), libs.runtime.loop)
+        return
+    panel_thread = threading.Thread(target=panel_thread_target, args=(msg_in_queue, name, settings_panel, panel_out_queue))
+    panel_thread.daemon = True
+    panel_thread.start()
+
+def reload_config():
+    # apply a changed config without dropping the connections, only panels
+    # with changed settings are rebuilt
+    global settings
+    with reload_lock:
+        old_settings = settings
+        if not get_config(get_config_file()):
+            settings = old_settings
+            return
+        if not old_settings or any(old_settings.get(key) != settings.get(key) for key in RESTART_SETTINGS):
+            logging.info("Connection settings changed, restarting.")
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+        apply_panel_defaults()
+        old_panels = old_settings["nspanels"]
+        new_panels = settings["nspanels"]
+        if mqtt_manager:
+            mqtt_manager.settings = settings
+
+        if not settings.get("subscribe_all_entities"):
+            libs.home_assistant.add_entities(get_config_entities())
+        libs.home_assistant.state_store.add_attributes(get_config_attributes())
+
+        for name, settings_panel in old_panels.items():
+            recv_topic = settings_panel["panelRecvTopic"]
+            new_settings_panel = new_panels.get(name)
+            if new_settings_panel is None or new_settings_panel["panelRecvTopic"] != recv_topic:
+                logging.info("Removing panel %s", name)
+                panel_in_queues[recv_topic].put(("CONFIG:", None))
+                del panel_in_queues[recv_topic]
+                libs.subscriptions.unsubscribe(recv_topic)
+                if mqtt_manager:
+                    mqtt_manager.client.unsubscribe(recv_topic)
+            elif new_settings_panel != settings_panel:
+                logging.info("Config of panel %s changed, rebuilding it", name)
+                set_serial_rate(new_settings_panel)
+                panel_in_queues[recv_topic].put(("CONFIG:", new_settings_panel))
+
+        for name, settings_panel in new_panels.items():
+            recv_topic = settings_panel["panelRecvTopic"]
+            if recv_topic not in panel_in_queues:
+                logging.info("Adding panel %s", name)
+                panel_in_queues[recv_topic] = PanelInbox(name)
+                if mqtt_manager:
+                    mqtt_manager.client.subscribe(recv_topic)
+                set_serial_rate(settings_panel)
+                start_panel(name, settings_panel)
+
+def remove_panel_output(old_panel, settings_panel):
+    # the panel is gone or sends to another topic now, forget the lane, serial
+    # budget and deduplication state of its old topic unless a panel uses it
+    if settings_panel is not None and settings_panel["panelSendTopic"] == old_panel.sendTopic:
+        return
+    if any(s["panelSendTopic"] == old_panel.sendTopic for s in settings["nspanels"].values()):
+        return
+    panel_out_queue.remove_topic(old_panel.sendTopic)
+    libs.panel_cmd.invalidate(old_panel.sendTopic)
+
+def handle_panel_msg(panel, msg):
+    if msg is None:
+        pass
+    elif msg[0] == "MQTT:":
+        libs.tracing.start(panel.recvTopic, panel.sendTopic, msg[1])
+        try:
+            panel.customrecv_event_callback(msg[1])
+        finally:
+            libs.tracing.stop()
+    elif msg[0] == "HA:":
+        panel.ha_event_callback(msg[1])
+    panel.flush_render()
 
 def panel_thread_target(queue_in, name, settings_panel, queue_out):
     panel = LovelaceUIPanel(name, settings_panel, queue_out)
+    report_startup(name)
     while True:
-        msg = queue_in.get()
-        if msg[0] == "MQTT:":
-            panel.customrecv_event_callback(msg[1])
-        elif msg[0] == "HA:":
-            panel.ha_event_callback(msg[1])
+        # wake up for a pending render even if no new messages arrive
+        msg = queue_in.get(timeout=panel.get_render_delay())
+        if msg is not None and msg[0] == "CONFIG:":
+            # new settings of this panel from reload_config, None removes it
+            old_panel = panel
+            if msg[1] is not None:
+                panel = LovelaceUIPanel(name, msg[1], queue_out)
+            old_panel.close()
+            remove_panel_output(old_panel, msg[1])
+            if msg[1] is None:
+                return
+            continue
+        handle_panel_msg(panel, msg)
+
+async def run_panels_async():
+    libs.runtime.loop = asyncio.get_running_loop()
+    await asyncio.gather(*[
+        panel_task(panel_in_queues[settings_panel["panelRecvTopic"]], name, settings_panel, panel_out_queue)
+        for name, settings_panel in settings["nspanels"].items()
+    ])
+
+async def panel_task(queue_in, name, settings_panel, queue_out):
+    loop = asyncio.get_running_loop()
+    queue_in.attach_loop(loop)
+    # creating a panel waits for the HA state cache, don't block the loop meanwhile
+    panel = await loop.run_in_executor(None, LovelaceUIPanel, name, settings_panel, queue_out)
+    report_startup(name)
+    while True:
+        msg = await queue_in.get_async(timeout=panel.get_render_delay())
+        try:
+            if msg is not None and msg[0] == "CONFIG:":
+                # new settings of this panel from reload_config, None removes it
+                old_panel = panel
+                if msg[1] is not None:
+                    panel = await loop.run_in_executor(None, LovelaceUIPanel, name, msg[1], queue_out)
+                await loop.run_in_executor(None, old_panel.close)
+                remove_panel_output(old_panel, msg[1])
+                if msg[1] is None:
+                    return
+                continue
+            # templates and sends to HA can block, the loop has to keep
+            # serving the other panels meanwhile
+            await loop.run_in_executor(None, handle_panel_msg, panel, msg)
+        except Exception:  # pylint: disable=broad-exception-caught
+            # don't take down the other panels
+            logging.exception("Failed to handle message for panel %s", name)
 
 def get_config_file():
     CONFIG_FILE = os.getenv('CONFIG_FILE')
@@ -149,6 +402,10 @@ def get_config(file):
             settings["home_assistant_token"] = st
             settings["home_assistant_address"] = "http://supervisor"
             settings["is_addon"] = True
+
+    # log panel interactions that took longer
+    slow_interaction_ms = settings.get("slow_interaction_ms")
+    libs.tracing.slow_threshold = slow_interaction_ms / 1000 if slow_interaction_ms else None
     return True
 
 def config_watch():
@@ -164,8 +421,11 @@ def config_watch():
 
         def on_modified(self, event):
             logging.info('Modification detected. Reloading panels.')
-            pid = os.getpid()
-            os.kill(pid, signal.SIGTERM)
+            try:
+                reload_config()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception("Failed to reload config, restarting.")
+                os.kill(os.getpid(), signal.SIGTERM)
 
     logging.info('Watching for changes in config file')
     project_files = []
@@ -186,12 +446,16 @@ if __name__ == '__main__':
     signal.signal(signal.SIGTERM, signal_handler)
     threading.Thread(target=config_watch).start()
     if (get_config(get_config_file())):
+        if settings.get("metrics_port"):
+            start_server(int(settings["metrics_port"]), settings.get("metrics_address", "127.0.0.1"))
         connect()
+        libs.home_assistant.prefetch_templates(get_config_templates())
         setup_panels()
 
         # main thread sleep forever
         while True:
             time.sleep(100)
+            log_inbox_stats()
     else:
         while True:
           time.sleep(100)
\ No newline at end of file
@@ -4,6 +4,7 @@ import logging
 import time
 import json
 import threading
+import libs.tracing
 
 
 class MqttManager:
@@ -51,6 +52,7 @@ class MqttManager:
                 data = json.loads(msg.payload.decode('utf-8'))
                 if "CustomRecv" in data:
                     queue = self.msg_out_queue_list[msg.topic]
+                    libs.tracing.received(msg.topic, data["CustomRecv"])
                     queue.put(("MQTT:", data["CustomRecv"]))
             else:
                 logging.debug("Received unhandled message on topic: %s", msg.topic)
@@ -65,4 +67,5 @@ class MqttManager:
     def process_in_queue(self, client, msg_in_queue):
         while True:
             msg = msg_in_queue.get()
-            client.publish(msg[0], msg[1])
\ No newline at end of file
+            client.publish(msg[0], msg[1])
+            libs.tracing.published(msg[0], msg[1])
\ No newline at end of file
@@ -1,15 +1,20 @@
-from dateutil import tz
-import datetime
-import threading
 import logging
+import libs.clock
+import libs.countdown
+import libs.home_assistant
+from libs.metrics import Histogram
 import libs.panel_cmd
-from scheduler import Scheduler
-import scheduler.trigger as trigger
+import libs.subscriptions
+import libs.tracing
 import time
-import babel.dates
 from ha_cards import Screensaver, card_factory, detail_open
 import ha_control
 
+# panel settings that can hold a "ha:" template
+PANEL_TEMPLATE_KEYS = ("sleepBrightness", "screenBrightness")
+
+RENDER_SECONDS = Histogram("nspanel_render_seconds", "Time to render a card")
+
 class LovelaceUIPanel:
 
     def __init__(self, name_panel, settings_panel, msg_out_queue):
@@ -23,12 +28,23 @@ class LovelaceUIPanel:
         self.temp_unit = self.settings.get("temp_unit", "celsius")
 
         self.current_card = None
+        # state changes are rendered at most once per renderInterval (seconds)
+        self.render_interval = self.settings.get("renderInterval", 0.1)
+        self.render_pending = False
+        self.last_render = 0
+        # state versions of the entities at the last render of the current card
+        self.rendered_versions = {}
         self.privious_cards = []
         self.cards = {}
         self.hidden_cards = {}
         self.screensaver = None
         self.navigate_keys = {}
-        self.entity_iids = {}
+        # iid of every entity on the panel to (card, entity)
+        self.iid_index = {}
+        # (detail_type, entity_id, panel entity id, effect list) of the open popup
+        self.open_popup = None
+        # templates subscribed for this panel, released by close
+        self.templates = []
 
         # generate cards for input settings
         for c in self.settings.get("cards"):
@@ -39,9 +55,7 @@ class LovelaceUIPanel:
                 # collect nav keys of cards
                 if card.navigate_key:
                     self.navigate_keys[card.navigate_key] = iid
-                # collect iids of entities
-                for e in card.get_iid_entities():
-                    self.entity_iids[e[0]] = e[1]
+                self.index_iids(card)
 
         # setup prev and next iids
         top_level_cards = list(self.cards.values())
@@ -60,36 +74,29 @@ class LovelaceUIPanel:
             # collect nav keys of cards
             if card.navigate_key:
                 self.navigate_keys[card.navigate_key] = iid
-            # collect iids of entities
-            for e in card.get_iid_entities():
-                self.entity_iids[e[0]] = e[1]
-
-        self.schedule = Scheduler()
-        self.schedule.minutely(datetime.time(second=0), self.update_time)
-        self.schedule.hourly(datetime.time(
-            minute=0, second=0), self.update_date)
-        schedule_thread = threading.Thread(target=self.schedule_thread_target)
-        schedule_thread.daemon = True
-        schedule_thread.start()
+            self.index_iids(card)
+
+        libs.clock.register_time(self.settings["timeZone"], self.settings.get("timeFormat", "%H:%M"), self.send_time)
+        libs.clock.register_date(self.settings["locale"], self.settings.get("dateFormat", "full"), self.send_date)
 
         # check if ha state cache is already populated
-        ha_control.wait_for_ha_cache()
+        if not ha_control.wait_for_ha_cache():
+            logging.warning("No states from Home Assistant yet, starting panel %s without them", self.name)
 
         #request templates on cards
-        if isinstance(self.settings.get("sleepBrightness",""), str) and self.settings.get("sleepBrightness", "").startswith("ha:"):
-            libs.home_assistant.cache_template(self.settings.get("sleepBrightness"))
-        if isinstance(self.settings.get("sleepBrightness",""), str) and self.settings.get("screenBrightness", "").startswith("ha:"):
-            libs.home_assistant.cache_template(self.settings.get("screenBrightness"))
+        for key in PANEL_TEMPLATE_KEYS:
+            if isinstance(self.settings.get(key), str) and self.settings[key].startswith("ha:"):
+                self.cache_template(self.settings[key])
         for c in self.cards.values():
             if hasattr(c, "qrcode"):
                 if c.qrcode.startswith("ha:"):
-                    libs.home_assistant.cache_template(c.qrcode)
+                    self.cache_template(c.qrcode)
             for e in c.entities:
                 e.prerender()
         for c in self.hidden_cards.values():
             if hasattr(c, "qrcode"):
                 if c.qrcode.startswith("ha:"):
-                    libs.home_assistant.cache_template(c.qrcode)
+                    self.cache_template(c.qrcode)
             for e in c.entities:
                 e.prerender()
         self.screensaver = Screensaver(self.settings["locale"], self.settings["screensaver"], self)
@@ -99,27 +106,61 @@ class LovelaceUIPanel:
             self.screensaver.statusIcon2.prerender()
         for e in self.screensaver.entities:
             e.prerender()
+        self.index_iids(self.screensaver)
 
+        # only receive HA updates for entities used on this panel
+        self.dim_entities = frozenset(ha_control.get_dim_entities(
+            self.settings.get("sleepTracking"),
+            self.settings.get("sleepBrightness"),
+            self.settings.get("screenBrightness"),
+            self.settings.get("sleepOverride"),
+        ))
+        libs.subscriptions.subscribe(self.recvTopic, self.get_entities())
+        libs.home_assistant.add_entities(self.get_entities())
+
+        # nothing sent before reached this panel object, e.g. after a config reload
+        libs.panel_cmd.invalidate(self.sendTopic)
         libs.panel_cmd.page_type(self.msg_out_queue, self.sendTopic, "pageStartup")
 
+    def cache_template(self, template):
+        libs.home_assistant.cache_template(template)
+        self.templates.append(template)
+
+    def close(self):
+        # stop everything that outlives this object, the subscriptions of the
+        # recv topic are replaced by the next panel or removed by the caller
+        libs.clock.unregister(self.send_time)
+        libs.clock.unregister(self.send_date)
+        libs.countdown.stop(self.sendTopic)
+        for template in self.templates:
+            libs.home_assistant.release_template(template)
+        self.templates = []
 
-    def schedule_thread_target(self):
-        while True:
-            self.schedule.exec_jobs()
-            time.sleep(1)
 
     def update_time(self):
-        use_timezone = tz.gettz(self.settings["timeZone"])
-        time_string = datetime.datetime.now(
-            use_timezone).strftime(self.settings["timeFormat"])
-        libs.panel_cmd.send_time(self.msg_out_queue, self.sendTopic, time_string)
+        self.send_time(libs.clock.format_time(self.settings["timeZone"], self.settings.get("timeFormat", "%H:%M")))
 
     def update_date(self):
-        dateformat = self.settings["dateFormat"]
-        date_string = babel.dates.format_date(
-            datetime.datetime.now(), dateformat, locale=self.settings["locale"])
+        self.send_date(libs.clock.format_date(self.settings["locale"], self.settings.get("dateFormat", "full")))
+
+    def send_time(self, time_string):
+        libs.panel_cmd.send_time(self.msg_out_queue, self.sendTopic, time_string)
+
+    def send_date(self, date_string):
         libs.panel_cmd.send_date(self.msg_out_queue, self.sendTopic, date_string)
 
+    def index_iids(self, card):
+        for e in card.get_iid_entities():
+            self.iid_index[e.iid] = (card, e)
+
+    def resolve_iid(self, entity_id):
+        # returns the ha entity id and the entity of an iid from the panel
+        if entity_id.startswith("iid."):
+            item = self.iid_index.get(entity_id[4:])
+            if item:
+                return item[1].entity_id, item[1]
+        return entity_id, None
+
     def searchCard(self, iid):
         if iid in self.navigate_keys:
             iid = self.navigate_keys[iid]
@@ -128,40 +169,25 @@ class LovelaceUIPanel:
         if iid in self.hidden_cards:
             return self.hidden_cards[iid]
 
+    def get_entities(self):
+        entities = set(self.dim_entities)
+        for card in [*self.cards.values(), *self.hidden_cards.values(), self.screensaver]:
+            entities.update(card.entity_ids)
+        return entities
+
     def ha_event_callback(self, entity_id):
         #logging.debug(f"{self.name} {entity_id} updated/state changed")
-        if self.current_card and entity_id in self.current_card.get_entities():
-            self.render_current_page(requested=True)
+        if self.current_card and entity_id in self.current_card.entity_ids:
+            version = libs.home_assistant.state_store.get_version(entity_id)
+            # templates have no version, they are rendered on every update
+            if not version or self.rendered_versions.get(entity_id) != version:
+                self.render_pending = True
 
             # send update for detail popup in case it's open
-            etype = entity_id.split('.')[0]
-            if etype in ['light', 'timer', 'cover', 'input_select', 'select', 'fan', 'climate']:
-                # figure out iid of entity
-                entity_id_iid = ""
-                for e in self.current_card.entities:
-                    if entity_id == e.entity_id:
-                        entity_id_iid = f'iid.{e.iid}'
-
-                    effectList = None
-                    if etype=="light":
-                        effectList = e.config.get("effectList")
-                if etype == 'light':
-                    libs.panel_cmd.entityUpdateDetail2(self.msg_out_queue, self.sendTopic, detail_open(self.settings["locale"], "popupInSel", entity_id, entity_id_iid, self.msg_out_queue, sendTopic=self.sendTopic, options_list=effectList))
-                    libs.panel_cmd.entityUpdateDetail(self.msg_out_queue, self.sendTopic, detail_open(self.settings["locale"], "popupLight", entity_id, entity_id_iid, self.msg_out_queue, sendTopic=self.sendTopic))
-                elif etype in ['input_select', 'media_player']:
-                    libs.panel_cmd.entityUpdateDetail2(self.msg_out_queue, self.sendTopic, detail_open(self.settings["locale"], etype, entity_id, entity_id_iid, self.msg_out_queue, sendTopic=self.sendTopic))
-                else:
-                    libs.panel_cmd.entityUpdateDetail(self.msg_out_queue, self.sendTopic, detail_open(self.settings["locale"], etype, entity_id, entity_id_iid, self.msg_out_queue, sendTopic=self.sendTopic))
-
-        involved_entities = ha_control.calculate_dim_values(
-            self.settings.get("sleepTracking"),
-            self.settings.get("sleepTrackingZones", ["not_home", "off"]),
-            self.settings.get("sleepBrightness"),
-            self.settings.get("screenBrightness"),
-            self.settings.get("sleepOverride"),
-            return_involved_entities=True
-        )
-        if entity_id in involved_entities:
+            if self.open_popup and self.open_popup[1] == entity_id:
+                self.send_detail(*self.open_popup)
+
+        if entity_id in self.dim_entities:
             self.dimmode()
 
 
@@ -169,9 +195,42 @@ class LovelaceUIPanel:
         if not self.current_card:
             return
         if switchPages:
+            # the panel requests the content of the new page by itself
+            self.render_pending = False
+            self.rendered_versions = {}
+            # leaving a page closes its popup as well
+            self.close_popup()
             libs.panel_cmd.page_type(self.msg_out_queue, self.sendTopic, self.current_card.type)
         if requested:
+            self.render_pending = False
+            self.last_render = time.monotonic()
+            state_store = libs.home_assistant.state_store
+            self.rendered_versions = {e: state_store.get_version(e) for e in self.current_card.entity_ids}
+            start = time.monotonic()
             self.current_card.render()
+            RENDER_SECONDS.observe(time.monotonic() - start, card=self.current_card.type)
+            libs.tracing.rendered(self.sendTopic)
+
+    def send_detail(self, detail_type, entity_id, panel_entity_id, effect_list):
+        out = detail_open(self.settings["locale"], detail_type, entity_id, panel_entity_id, self.msg_out_queue, sendTopic=self.sendTopic, options_list=effect_list)
+        if detail_type == "popupInSel":
+            libs.panel_cmd.entityUpdateDetail2(self.msg_out_queue, self.sendTopic, out)
+        else:
+            libs.panel_cmd.entityUpdateDetail(self.msg_out_queue, self.sendTopic, out)
+
+    def close_popup(self):
+        self.open_popup = None
+        libs.countdown.stop(self.sendTopic)
+
+    def get_render_delay(self):
+        # seconds until the pending render is due, None if there is none
+        if not self.render_pending:
+            return None
+        return max(0, self.last_render + self.render_interval - time.monotonic())
+
+    def flush_render(self):
+        if self.render_pending and self.get_render_delay() == 0:
+            self.render_current_page(requested=True)
 
     def dimmode(self):
         # send dimmode
@@ -206,6 +265,8 @@ class LovelaceUIPanel:
         # run action based on received command
         if msg[0] == "event":
             if msg[1] == "startup":
+                # panel (re)started and shows nothing we sent before
+                libs.panel_cmd.invalidate(self.sendTopic)
                 # TODO: Handle Update Messages
                 self.update_date()
                 self.update_time()
@@ -225,6 +286,7 @@ class LovelaceUIPanel:
                 self.current_card = self.screensaver
                 self.render_current_page(switchPages=True)
             if msg[1] == "renderCurrentPage":
+                libs.panel_cmd.invalidate(self.sendTopic, libs.panel_cmd.PAGE_COMMANDS)
                 self.render_current_page(requested=True)
             if msg[1] == "buttonPress2":
                 entity_id = msg[2]
@@ -249,12 +311,8 @@ class LovelaceUIPanel:
                     return
 
                 # replace iid with real entity id
-                if entity_id.startswith("iid."):
-                    iid = entity_id.split(".")[1]
-                    for e in self.current_card.entities:
-                        if e.iid == iid:
-                            entity_id = e.entity_id
-                            entity_config = e.config
+                entity_id, entity = self.resolve_iid(entity_id)
+                entity_config = entity.config if entity else None
 
                 match btype:
                     case 'button':
@@ -286,19 +344,15 @@ class LovelaceUIPanel:
                         ha_control.handle_buttons(entity_id, btype, value)
 
             if msg[1] == "pageOpenDetail":
-                entity_id = msg[3]
+                libs.panel_cmd.invalidate(self.sendTopic, ["entityUpdateDetail", "entityUpdateDetail2"])
+                self.close_popup()
                 # replace iid with real entity id
-                if entity_id.startswith("iid."):
-                    iid = entity_id.split(".")[1]
-                    for e in self.current_card.entities:
-                        if e.iid == iid:
-                            entity_id = e.entity_id
-                            effectList = None
-                            if entity_id.startswith("light"):
-                                effectList = e.config.get("effectList")
-                if msg[2] == "popupInSel": #entity_id.split(".")[0] in ['input_select', 'media_player']:
-                    libs.panel_cmd.entityUpdateDetail2(self.msg_out_queue, self.sendTopic, detail_open(self.settings["locale"], msg[2], entity_id, msg[3], self.msg_out_queue, sendTopic=self.sendTopic, options_list=effectList))
-                else:
-                    libs.panel_cmd.entityUpdateDetail(self.msg_out_queue, self.sendTopic, detail_open(self.settings["locale"], msg[2], entity_id, msg[3], self.msg_out_queue, sendTopic=self.sendTopic))
+                entity_id, entity = self.resolve_iid(msg[3])
+                effectList = None
+                if entity and entity_id.startswith("light"):
+                    effectList = entity.config.get("effectList")
+                # state changes of this entity update the popup until it's closed
+                self.open_popup = (msg[2], entity_id, msg[3], effectList)
+                self.send_detail(*self.open_popup)
 
 